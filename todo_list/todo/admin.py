@@ -1,9 +1,200 @@
 from django.contrib import admin
+from django.contrib.admin import widgets
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils import timezone
+from django.utils.functional import cached_property
+from . import reminders, sharding
 from .models import Folder, Page, Task, FolderPermission, PagePermission, TaskPermission
 
-admin.site.register(Folder)
-admin.site.register(Page)
-admin.site.register(Task)
-admin.site.register(FolderPermission)
-admin.site.register(PagePermission)
-admin.site.register(TaskPermission)
+
+class EstimatedCountPaginator(Paginator):
+    # Ниже этого порога считаем точно, выше - берём оценку планировщика PostgreSQL
+    estimate_threshold = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        query = getattr(queryset, 'query', None)
+        # Оценка возможна только для нефильтрованного списка всей таблицы
+        if query is None or query.where:
+            return super().count
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return super().count
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        if row is None or row[0] < self.estimate_threshold:
+            return super().count
+        return row[0]
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    # Только выбор шарда в списке: саму базу переключает ShardedAdmin.changelist_view
+    title = 'шард'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in sharding.get_shards()]
+
+    def queryset(self, request, queryset):
+        return queryset
+
+
+class ShardedAdmin(admin.ModelAdmin):
+    # Каждая страница админки работает с одним шардом, как и запросы API: объект ищется по id,
+    # новый объект создается на шарде родителя (shard_parent_field) или владельца (shard_owner_field),
+    # список показывает шард, выбранный в фильтре (по умолчанию - базу-каталог)
+    shard_parent_field = None
+    shard_owner_field = None
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        return (ShardListFilter, *list_filter) if sharding.is_sharded() else list_filter
+
+    def get_autocomplete_fields(self, request):
+        # Автодополнение идет отдельным запросом без шарда, поэтому при нескольких шардах связи вводятся по id
+        return () if sharding.is_sharded() else super().get_autocomplete_fields(request)
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if sharding.is_sharded() and db_field.name in self.autocomplete_fields:
+            kwargs.setdefault('widget', widgets.ForeignKeyRawIdWidget(
+                db_field.remote_field, self.admin_site, using=kwargs.get('using'),
+            ))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def get_selected_shard(self, request):
+        alias = request.GET.get(ShardListFilter.parameter_name)
+        return alias if alias in sharding.get_shards() else sharding.get_directory_db()
+
+    def get_object_shard(self, request, object_id):
+        if not str(object_id).isdigit():
+            return self.get_selected_shard(request)
+        return sharding.locate_shard(self.model, object_id) or self.get_selected_shard(request)
+
+    def get_add_shard(self, request):
+        if request.method == 'POST' and self.shard_parent_field:
+            parent_id = request.POST.get(self.shard_parent_field)
+            if parent_id and parent_id.isdigit():
+                parent_model = self.model._meta.get_field(self.shard_parent_field).related_model
+                alias = sharding.locate_shard(parent_model, parent_id)
+                if alias is not None:
+                    return alias
+        if request.method == 'POST' and self.shard_owner_field:
+            owner_id = request.POST.get(self.shard_owner_field)
+            if owner_id and owner_id.isdigit():
+                return sharding.shard_for_owner(int(owner_id))
+        return self.get_selected_shard(request)
+
+    def on_shard(self, alias, view, *args, **kwargs):
+        with sharding.use_shard(alias):
+            response = view(*args, **kwargs)
+            # TemplateResponse рендерится лениво: запросы шаблона тоже должны уйти в этот шард
+            if hasattr(response, 'render'):
+                response.render()
+        return response
+
+    def changelist_view(self, request, extra_context=None):
+        return self.on_shard(self.get_selected_shard(request), super().changelist_view, request, extra_context)
+
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        alias = self.get_add_shard(request) if object_id is None else self.get_object_shard(request, object_id)
+        return self.on_shard(alias, super().changeform_view, request, object_id, form_url, extra_context)
+
+    def delete_view(self, request, object_id, extra_context=None):
+        return self.on_shard(self.get_object_shard(request, object_id), super().delete_view,
+                             request, object_id, extra_context)
+
+    def history_view(self, request, object_id, extra_context=None):
+        return self.on_shard(self.get_object_shard(request, object_id), super().history_view,
+                             request, object_id, extra_context)
+
+
+class SoftDeletableAdmin(ShardedAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ('-id',)
+    actions = ('soft_delete_selected', 'restore_selected')
+
+    @admin.action(description='Мягко удалить выбранные записи')
+    def soft_delete_selected(self, request, queryset):
+        updated = queryset.filter(is_deleted=False).update(is_deleted=True, deleted_at=timezone.now())
+        self.message_user(request, f'Удалено записей: {updated}')
+
+    @admin.action(description='Восстановить выбранные записи')
+    def restore_selected(self, request, queryset):
+        queryset = queryset.filter(is_deleted=True)
+        if queryset.model is Task:
+            reminders.record_changes(queryset)
+        updated = queryset.update(is_deleted=False, deleted_at=None)
+        self.message_user(request, f'Восстановлено записей: {updated}')
+
+
+@admin.register(Folder)
+class FolderAdmin(SoftDeletableAdmin):
+    list_display = ('id', 'name', 'owner', 'is_public', 'is_deleted')
+    list_select_related = ('owner',)
+    list_filter = ('is_public', 'is_deleted')
+    search_fields = ('name',)
+    raw_id_fields = ('owner', 'parent')
+    shard_parent_field = 'parent'
+    shard_owner_field = 'owner'
+
+
+@admin.register(Page)
+class PageAdmin(SoftDeletableAdmin):
+    list_display = ('id', 'name', 'folder', 'is_public', 'is_deleted', 'updated_at')
+    list_select_related = ('folder',)
+    list_filter = ('is_public', 'is_deleted')
+    search_fields = ('name',)
+    autocomplete_fields = ('folder',)
+    raw_id_fields = ('created_by', 'updated_by')
+    shard_parent_field = 'folder'
+
+
+@admin.register(Task)
+class TaskAdmin(SoftDeletableAdmin):
+    list_display = ('id', 'short_text', 'status', 'page', 'user', 'is_deleted', 'updated_at')
+    list_select_related = ('page', 'user')
+    list_filter = ('status', 'is_deleted')
+    raw_id_fields = ('page', 'user', 'created_by', 'updated_by', 'previous_version')
+    shard_parent_field = 'page'
+
+    @admin.display(description='Текст')
+    def short_text(self, obj):
+        return obj.text[:50]
+
+
+class PermissionAdmin(ShardedAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ('-id',)
+    raw_id_fields = ('user',)
+
+
+@admin.register(FolderPermission)
+class FolderPermissionAdmin(PermissionAdmin):
+    list_display = ('id', 'folder', 'user', 'can_view', 'can_edit', 'can_delete')
+    list_select_related = ('folder', 'user')
+    autocomplete_fields = ('folder',)
+    shard_parent_field = 'folder'
+
+
+@admin.register(PagePermission)
+class PagePermissionAdmin(PermissionAdmin):
+    list_display = ('id', 'page', 'user', 'can_view', 'can_edit', 'can_delete')
+    list_select_related = ('page', 'user')
+    autocomplete_fields = ('page',)
+    shard_parent_field = 'page'
+
+
+@admin.register(TaskPermission)
+class TaskPermissionAdmin(PermissionAdmin):
+    list_display = ('id', 'task', 'user', 'can_view', 'can_edit', 'can_delete')
+    list_select_related = ('task', 'user')
+    raw_id_fields = ('task', 'user')
+    shard_parent_field = 'task'
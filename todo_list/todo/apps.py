@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save, pre_save
 
 
 class TodoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'todo'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from . import reminders, sharding
+        from .signals import fields_updated
+
+        for model_name in sharding.GLOBAL_ID_MODELS:
+            pre_save.connect(sharding.assign_id, sender=self.get_model(model_name),
+                             dispatch_uid=f'todo_assign_id_{model_name}')
+        post_save.connect(sharding.replicate_user, sender=User, dispatch_uid='todo_replicate_user')
+        post_delete.connect(sharding.delete_replicated_user, sender=User, dispatch_uid='todo_delete_replicated_user')
+        task = self.get_model('task')
+        post_save.connect(reminders.record_change, sender=task, dispatch_uid='todo_reminder_change')
+        fields_updated.connect(reminders.record_fields_change, sender=task, dispatch_uid='todo_reminder_fields_change')
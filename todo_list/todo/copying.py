@@ -0,0 +1,248 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import sharding
+from .models import (CopyJob, Folder, FolderClosure, FolderPermission, Page, PagePermission, ReminderChange,
+                     Task, TaskPermission)
+from .retention import PERMISSION_FIELDS
+
+# Копирование поддерева целиком на сервере: строки читаются пачками, внешние ключи переназначаются
+# в памяти по словарям "старый id -> новый id", вставка идет через bulk_create.
+# Копия создается на шарде исходного объекта.
+
+DEFAULT_COPY = {
+    # Больше страниц и задач - копирование уходит в CopyJob
+    'SYNC_LIMIT': 5000,
+    'BATCH_SIZE': 1000,
+}
+
+
+def get_copy_settings():
+    return {**DEFAULT_COPY, **getattr(settings, 'TODO_COPY', {})}
+
+
+def clone(obj, **values):
+    copy = type(obj)(**{field.attname: getattr(obj, field.attname)
+                        for field in obj._meta.concrete_fields if not field.primary_key})
+    for name, value in values.items():
+        setattr(copy, name, value)
+    return copy
+
+
+def copy_names(model, names, using):
+    # Имена папок и страниц уникальны: копии получают суффикс " (копия)", " (копия 2)" и т.д.
+    max_length = model._meta.get_field('name').max_length
+    result = [None] * len(names)
+    pending = list(range(len(names)))
+    taken = set()
+    number = 1
+    while pending:
+        suffix = ' (копия)' if number == 1 else f' (копия {number})'
+        candidates = {index: names[index][:max_length - len(suffix)] + suffix for index in pending}
+        taken.update(model._base_manager.using(using).filter(name__in=set(candidates.values()))
+                     .values_list('name', flat=True))
+        pending = []
+        for index, candidate in candidates.items():
+            if candidate in taken:
+                pending.append(index)
+            else:
+                taken.add(candidate)
+                result[index] = candidate
+        number += 1
+    return result
+
+
+def rename_copies(model, copies, using):
+    for copy, name in zip(copies, copy_names(model, [copy.name for copy in copies], using)):
+        copy.name = name
+
+
+def bulk_insert(model, objs, batch_size, using):
+    # pre_save с выдачей глобальных id при bulk_create не срабатывает
+    sharding.assign_ids(objs, using)
+    return model.objects.using(using).bulk_create(objs, batch_size=batch_size)
+
+
+def copy_grants(permission_model, field, id_map, batch_size, using):
+    grants = permission_model.objects.using(using).filter(**{f'{field}_id__in': list(id_map)})
+    bulk_insert(permission_model, [
+        permission_model(**{f'{field}_id': id_map[getattr(grant, f'{field}_id')]},
+                         **{name: getattr(grant, name) for name in PERMISSION_FIELDS})
+        for grant in grants
+    ], batch_size, using)
+
+
+def copy_tasks(page_map, user, with_permissions, batch_size, using):
+    now = timezone.now()
+    task_ids = list(Task.objects.using(using).filter(page_id__in=list(page_map), is_deleted=False)
+                    .order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(task_ids), batch_size):
+        sources = Task.objects.using(using).filter(pk__in=task_ids[start:start + batch_size])
+        # Ключи rank сравниваются только внутри страницы - порядок задач в копии сохраняется как есть
+        pairs = [(task.pk, clone(
+            task,
+            page_id=page_map[task.page_id],
+            previous_version_id=None,
+            version=1,
+            created_by_id=user.pk,
+            updated_by_id=user.pk,
+            remind_at=task.remind_at if task.remind_at and task.remind_at > now else None,
+            reminded_at=None,
+        )) for task in sources]
+        bulk_insert(Task, [copy for _, copy in pairs], batch_size, using)
+        ReminderChange.objects.using(using).bulk_create([
+            ReminderChange(task_id=copy.pk) for _, copy in pairs if copy.remind_at is not None
+        ])
+        if with_permissions:
+            copy_grants(TaskPermission, 'task', {pk: copy.pk for pk, copy in pairs}, batch_size, using)
+
+
+def copy_pages(page_ids, folder_map, user, with_permissions, batch_size, using, name=None):
+    page_map = {}
+    for start in range(0, len(page_ids), batch_size):
+        sources = Page.objects.using(using).filter(pk__in=page_ids[start:start + batch_size])
+        pairs = [(page.pk, clone(
+            page,
+            folder_id=folder_map[page.folder_id],
+            version=1,
+            created_by_id=user.pk,
+            updated_by_id=user.pk,
+        )) for page in sources]
+        if name:
+            for _, copy in pairs:
+                copy.name = name
+        else:
+            rename_copies(Page, [copy for _, copy in pairs], using)
+        bulk_insert(Page, [copy for _, copy in pairs], batch_size, using)
+        chunk_map = {pk: copy.pk for pk, copy in pairs}
+        if with_permissions:
+            copy_grants(PagePermission, 'page', chunk_map, batch_size, using)
+        copy_tasks(chunk_map, user, with_permissions, batch_size, using)
+        page_map.update(chunk_map)
+    return page_map
+
+
+def copy_folder(folder, parent, user, name=None, with_permissions=False, batch_size=None):
+    # Копирует папку со всеми неудаленными вложенными папками, страницами и задачами в parent.
+    # Владельцем всех скопированных папок становится user
+    batch_size = batch_size or get_copy_settings()['BATCH_SIZE']
+    using = folder._state.db
+    with transaction.atomic(using=using):
+        depths = dict(FolderClosure.objects.using(using).filter(ancestor=folder)
+                      .values_list('descendant_id', 'depth'))
+        sources = Folder.objects.using(using).filter(pk__in=list(depths), is_deleted=False)
+        levels = {}
+        for source in sources:
+            levels.setdefault(depths[source.pk], []).append(source)
+
+        # Уровень за уровнем: к вставке детей id родителей уже известны
+        folder_map = {}
+        for depth in sorted(levels):
+            pairs = []
+            for source in levels[depth]:
+                if depth == 0:
+                    parent_id = parent.pk if parent else None
+                elif source.parent_id in folder_map:
+                    parent_id = folder_map[source.parent_id]
+                else:
+                    continue
+                pairs.append((source.pk, clone(source, parent_id=parent_id, owner_id=user.pk)))
+            if depth == 0 and name:
+                pairs[0][1].name = name
+            else:
+                rename_copies(Folder, [copy for _, copy in pairs], using)
+            bulk_insert(Folder, [copy for _, copy in pairs], batch_size, using)
+            folder_map.update({pk: copy.pk for pk, copy in pairs})
+
+        # Таблица замыканий: связи внутри копии повторяют исходные, предки parent - общие для всей копии
+        links = [
+            FolderClosure(ancestor_id=folder_map[ancestor_id], descendant_id=folder_map[descendant_id], depth=depth)
+            for ancestor_id, descendant_id, depth in FolderClosure.objects.using(using)
+            .filter(ancestor_id__in=folder.subtree_ids()).values_list('ancestor_id', 'descendant_id', 'depth')
+            if ancestor_id in folder_map and descendant_id in folder_map
+        ]
+        if parent is not None:
+            for ancestor_id, parent_depth in FolderClosure.objects.using(using).filter(descendant=parent) \
+                    .values_list('ancestor_id', 'depth'):
+                links.extend(
+                    FolderClosure(ancestor_id=ancestor_id, descendant_id=copy_id, depth=parent_depth + depths[pk] + 1)
+                    for pk, copy_id in folder_map.items()
+                )
+        FolderClosure.objects.using(using).bulk_create(links, batch_size=batch_size)
+
+        if with_permissions:
+            copy_grants(FolderPermission, 'folder', folder_map, batch_size, using)
+        page_ids = list(Page.objects.using(using).filter(folder_id__in=list(folder_map), is_deleted=False)
+                        .order_by('pk').values_list('pk', flat=True))
+        copy_pages(page_ids, folder_map, user, with_permissions, batch_size, using)
+    return Folder.objects.using(using).get(pk=folder_map[folder.pk])
+
+
+def copy_page(page, folder, user, name=None, with_permissions=False, batch_size=None):
+    batch_size = batch_size or get_copy_settings()['BATCH_SIZE']
+    using = page._state.db
+    with transaction.atomic(using=using):
+        page_map = copy_pages([page.pk], {page.folder_id: folder.pk}, user, with_permissions, batch_size, using,
+                              name=name)
+    return Page.objects.using(using).get(pk=page_map[page.pk])
+
+
+def copy_size(kind, source):
+    if kind == 'folder':
+        pages = Page.objects.using(source._state.db).filter(folder__in=source.subtree_ids(), is_deleted=False)
+    else:
+        pages = Page.objects.using(source._state.db).filter(pk=source.pk)
+    tasks = Task.objects.using(source._state.db).filter(page__in=pages, is_deleted=False)
+    return pages.count() + tasks.count()
+
+
+def start_copy(kind, source, target, user, name=None, with_permissions=False):
+    # Небольшие поддеревья копируются сразу, большие ставятся в очередь: возвращает (копия, None) или (None, задание)
+    if copy_size(kind, source) <= get_copy_settings()['SYNC_LIMIT']:
+        copy = copy_folder if kind == 'folder' else copy_page
+        return copy(source, target, user, name=name, with_permissions=with_permissions), None
+    job = CopyJob.objects.using(source._state.db).create(
+        kind=kind,
+        source_id=source.pk,
+        target_id=target.pk if target else None,
+        name=name or '',
+        with_permissions=with_permissions,
+        user=user,
+    )
+    return None, job
+
+
+def run_job(job):
+    using = job._state.db
+    # Захватываем задание, чтобы параллельный запуск команды его пропустил
+    claimed = CopyJob.objects.using(using).filter(pk=job.pk, status='PENDING').update(status='RUNNING')
+    if not claimed:
+        return False
+    source_model = Folder if job.kind == 'folder' else Page
+    try:
+        source = source_model.objects.using(using).get(pk=job.source_id, is_deleted=False)
+        target = Folder.objects.using(using).get(pk=job.target_id, is_deleted=False) \
+            if job.target_id is not None else None
+        copy = copy_folder if job.kind == 'folder' else copy_page
+        result = copy(source, target, job.user, name=job.name or None, with_permissions=job.with_permissions)
+    except (Folder.DoesNotExist, Page.DoesNotExist):
+        job.status, job.error = 'FAILED', 'Исходный объект или папка назначения удалены'
+    except Exception as error:
+        job.status, job.error = 'FAILED', str(error)
+    else:
+        job.status, job.result_id = 'DONE', result.pk
+    job.finished_at = timezone.now()
+    job.save(using=using, update_fields=['status', 'error', 'result_id', 'finished_at'])
+    return True
+
+
+def run_pending_jobs(max_jobs=None):
+    done = 0
+    for shard in sharding.get_shards():
+        with sharding.use_shard(shard):
+            for job in CopyJob.objects.filter(status='PENDING').order_by('pk').select_related('user'):
+                if max_jobs is not None and done >= max_jobs:
+                    return done
+                done += run_job(job)
+    return done
@@ -0,0 +1,117 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from rest_framework import serializers
+
+from . import sharding
+from .models import Folder, FolderPermission, Page, PagePermission, Task, TaskPermission
+
+# Пакетная выдача и отзыв прав: права проверяются один раз на каждый объект,
+# изменения пишутся одной транзакцией - DELETE и upsert на каждую таблицу прав
+
+GRANT_MODELS = {
+    'folder': FolderPermission,
+    'page': PagePermission,
+    'task': TaskPermission,
+}
+GRANT_FLAGS = ('can_view', 'can_edit', 'can_delete')
+
+DENIED_MESSAGES = {
+    'folder': "Вы не можете назначать права для папок: {}",
+    'page': "Вы не можете назначать права для страниц: {}",
+    'task': "Вы не можете назначать права для задач: {}",
+}
+
+
+def load_targets(kind, ids):
+    if kind == 'folder':
+        queryset = Folder.objects.all()
+    elif kind == 'page':
+        queryset = Page.objects.select_related('folder')
+    else:
+        queryset = Task.objects.select_related('page__folder')
+    return queryset.filter(is_deleted=False).in_bulk(ids)
+
+
+def target_folder(kind, obj):
+    if kind == 'folder':
+        return obj
+    page = obj if kind == 'page' else obj.page
+    return page.folder if page else None
+
+
+def check_access(user, targets):
+    # Те же правила, что в FolderPermissionViewSet/PagePermissionViewSet/TaskPermissionViewSet:
+    # права папки назначает владелец, права страниц и задач - владелец папки или пользователь с правами на нее
+    folders = {(kind, pk): target_folder(kind, obj) for kind, objs in targets.items() for pk, obj in objs.items()}
+    shared = set(FolderPermission.objects.filter(
+        user=user,
+        folder_id__in={folder.pk for (kind, _), folder in folders.items() if kind != 'folder' and folder},
+    ).values_list('folder_id', flat=True))
+    errors = {}
+    for kind, objs in targets.items():
+        denied = []
+        for pk in objs:
+            folder = folders[kind, pk]
+            if folder is None:
+                denied.append(pk)
+            elif folder.owner_id != user.pk and (kind == 'folder' or folder.pk not in shared):
+                denied.append(pk)
+        if denied:
+            errors[kind] = DENIED_MESSAGES[kind].format(', '.join(map(str, sorted(denied))))
+    if errors:
+        raise serializers.ValidationError(errors)
+
+
+def apply_batch(user, grant, revoke, batch_size=1000):
+    # grant/revoke - списки {'kind', 'target', 'user', флаги}; сначала отзыв, потом выдача
+    ids = {kind: set() for kind in GRANT_MODELS}
+    for item in grant + revoke:
+        ids[item['kind']].add(item['target'])
+
+    targets = {kind: load_targets(kind, kind_ids) for kind, kind_ids in ids.items() if kind_ids}
+    missing = {kind: sorted(kind_ids - set(targets.get(kind, {}))) for kind, kind_ids in ids.items()}
+    errors = {kind: f"Не найдены: {', '.join(map(str, pks))}" for kind, pks in missing.items() if pks}
+    if errors:
+        raise serializers.ValidationError(errors)
+
+    user_ids = {item['user'] for item in grant + revoke}
+    missing_users = user_ids - set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+    if missing_users:
+        raise serializers.ValidationError(
+            {"user": f"Пользователи не найдены: {', '.join(map(str, sorted(missing_users)))}"}
+        )
+
+    check_access(user, targets)
+
+    stats = {'granted': {}, 'revoked': {}}
+    with transaction.atomic(using=sharding.current_db(FolderPermission)):
+        for kind, model in GRANT_MODELS.items():
+            by_user = {}
+            for item in revoke:
+                if item['kind'] == kind:
+                    by_user.setdefault(item['user'], set()).add(item['target'])
+            if by_user:
+                condition = Q()
+                for user_id, target_ids in by_user.items():
+                    condition |= Q(user_id=user_id, **{f'{kind}_id__in': target_ids})
+                stats['revoked'][kind], _ = model.objects.filter(condition).delete()
+
+            # Повтор пары в одном запросе: побеждает последняя запись
+            rows = {(item['target'], item['user']): item for item in grant if item['kind'] == kind}
+            if rows:
+                objs = [
+                    model(**{f'{kind}_id': target_id, 'user_id': user_id},
+                          **{flag: item[flag] for flag in GRANT_FLAGS})
+                    for (target_id, user_id), item in rows.items()
+                ]
+                sharding.assign_ids(objs, sharding.current_db(model))
+                model.objects.bulk_create(
+                    objs,
+                    batch_size=batch_size,
+                    update_conflicts=True,
+                    unique_fields=[kind, 'user'],
+                    update_fields=list(GRANT_FLAGS),
+                )
+                stats['granted'][kind] = len(objs)
+    return stats
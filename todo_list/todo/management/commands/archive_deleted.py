@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from todo.retention import run_retention
+
+
+class Command(BaseCommand):
+    help = ('Переносит давно удаленные папки, страницы и задачи в архивные таблицы '
+            'и окончательно удаляет устаревшие архивные записи')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--archive-after', type=int,
+                            help='Архивировать записи, удаленные больше указанного числа дней назад')
+        parser.add_argument('--purge-after', type=int,
+                            help='Окончательно удалять архивные записи старше указанного числа дней')
+        parser.add_argument('--batch-size', type=int,
+                            help='Количество строк в одной транзакции')
+        parser.add_argument('--max-batches', type=int,
+                            help='Остановиться после указанного числа пачек; следующий запуск продолжит')
+
+    def handle(self, *args, **options):
+        stats = run_retention(
+            archive_after_days=options['archive_after'],
+            purge_after_days=options['purge_after'],
+            batch_size=options['batch_size'],
+            max_batches=options['max_batches'],
+        )
+        for model_name, counts in stats.items():
+            self.stdout.write(f"{model_name}: в архив {counts['archived']}, удалено {counts['purged']}")
+        self.stdout.write(self.style.SUCCESS('Готово'))
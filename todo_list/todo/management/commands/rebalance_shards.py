@@ -0,0 +1,68 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from todo import sharding
+
+
+class Command(BaseCommand):
+    help = ('Показывает нагрузку на шарды и переносит поддеревья папок владельцев между ними. '
+            'Переносимые данные не должны меняться во время работы команды.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owner', type=int, help='Перенести данные этого владельца')
+        parser.add_argument('--to', dest='target', help='Шард, на который переносить')
+        parser.add_argument('--auto', action='store_true',
+                            help='Переносить владельцев с самого загруженного шарда на самый свободный')
+        parser.add_argument('--tolerance', type=float, default=0.1,
+                            help='Допустимая разница нагрузки шардов для --auto, доля от средней')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать план')
+        parser.add_argument('--sync-users', action='store_true',
+                            help='Скопировать всех пользователей из каталога на шарды')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        shards = sharding.get_shards()
+        if options['sync_users']:
+            for user in User.objects.using(sharding.get_directory_db()).iterator():
+                sharding.replicate_user(User, user, using=sharding.get_directory_db())
+            self.stdout.write('Пользователи скопированы на шарды')
+
+        loads = sharding.run_on_shards(sharding.owner_loads, shards)
+        for shard in shards:
+            self.stdout.write(f'{shard}: владельцев {len(loads[shard])}, задач {sum(loads[shard].values())}')
+
+        if options['owner'] is not None:
+            if options['target'] not in shards:
+                raise CommandError(f'Укажите --to, один из: {", ".join(shards)}')
+            for source in sharding.owner_shards(options['owner']):
+                self.move(options['owner'], source, options['target'], options)
+        elif options['auto']:
+            self.auto_balance(loads, options)
+
+    def move(self, owner_id, source, target, options):
+        self.stdout.write(f'Владелец {owner_id}: {source} -> {target}')
+        if options['dry_run'] or source == target:
+            return
+        stats = sharding.move_owner(owner_id, source, target, batch_size=options['batch_size'])
+        for model_name, count in stats.items():
+            self.stdout.write(f'  {model_name}: {count}')
+
+    def auto_balance(self, loads, options):
+        totals = {shard: sum(owners.values()) for shard, owners in loads.items()}
+        tolerance = sum(totals.values()) / len(totals) * options['tolerance']
+        while True:
+            heaviest = max(totals, key=totals.get)
+            lightest = min(totals, key=totals.get)
+            gap = totals[heaviest] - totals[lightest]
+            if gap <= tolerance:
+                break
+            # Самый крупный владелец, перенос которого сокращает разрыв
+            candidates = [(load, owner) for owner, load in loads[heaviest].items() if 0 < load < gap]
+            if not candidates:
+                break
+            load, owner = max(candidates)
+            self.move(owner, heaviest, lightest, options)
+            loads[lightest][owner] = loads[lightest].get(owner, 0) + loads[heaviest].pop(owner)
+            totals[heaviest] -= load
+            totals[lightest] += load
+        self.stdout.write(self.style.SUCCESS('Готово'))
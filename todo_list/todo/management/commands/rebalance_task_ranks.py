@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.db.models.functions import Length
+
+from todo.models import Task
+from todo.ranking import RANK_REBALANCE_LENGTH
+from todo.sharding import get_shards, use_shard
+
+
+class Command(BaseCommand):
+    help = 'Перенумеровывает ключи порядка задач на страницах, где они стали слишком длинными'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-length', type=int, default=RANK_REBALANCE_LENGTH,
+                            help='Перенумеровать страницы с ключом длиннее этого значения')
+        parser.add_argument('--page', type=int, action='append', dest='pages',
+                            help='Перенумеровать только указанные страницы')
+
+    def handle(self, *args, **options):
+        pages = 0
+        for shard in get_shards():
+            with use_shard(shard):
+                if options['pages']:
+                    page_ids = Task.objects.filter(page_id__in=options['pages']) \
+                        .values_list('page_id', flat=True).distinct()
+                else:
+                    page_ids = (
+                        Task.objects.exclude(page=None)
+                        .values('page_id')
+                        .annotate(longest=Max(Length('rank')))
+                        .filter(longest__gt=options['min_length'])
+                        .values_list('page_id', flat=True)
+                    )
+                for page_id in list(page_ids):
+                    count = Task.rebalance_ranks(page_id)
+                    pages += 1
+                    self.stdout.write(f'Страница {page_id}: перенумеровано задач {count}')
+        self.stdout.write(self.style.SUCCESS(f'Готово, страниц: {pages}'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from todo.copying import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = 'Выполняет отложенные копирования папок и страниц (CopyJob)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-jobs', type=int, help='Остановиться после стольких заданий')
+
+    def handle(self, *args, **options):
+        done = run_pending_jobs(max_jobs=options['max_jobs'])
+        self.stdout.write(self.style.SUCCESS(f'Готово, заданий: {done}'))
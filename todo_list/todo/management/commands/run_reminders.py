@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from todo.reminders import run_schedulers
+from todo.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = ('Планировщик напоминаний о задачах: держит ближайшие напоминания в памяти '
+            'и отправляет сигнал todo.signals.reminders_due пачками')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', action='append', dest='shards', help='Обслуживать только указанные шарды')
+        parser.add_argument('--tick', type=int, default=1, help='Точность срабатывания, секунды')
+        parser.add_argument('--slots', type=int, default=3600,
+                            help='Число ячеек колеса; горизонт в памяти - tick * slots секунд')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--once', action='store_true',
+                            help='Отправить наступившие напоминания и выйти (для запуска по расписанию)')
+
+    def handle(self, *args, **options):
+        shards = options['shards'] or get_shards()
+        unknown = set(shards) - set(get_shards())
+        if unknown:
+            raise CommandError(f'Неизвестные шарды: {", ".join(sorted(unknown))}')
+        run_schedulers(
+            shards=shards,
+            tick=options['tick'],
+            slots=options['slots'],
+            batch_size=options['batch_size'],
+            once=options['once'],
+            on_fired=lambda shard, count: self.stdout.write(f'{shard}: напоминаний {count}'),
+        )
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.3 on 2026-10-19 11:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todo', '0003_remove_task_folder'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='folder',
+            name='is_deleted',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='folder',
+            name='is_public',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='page',
+            name='is_deleted',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='page',
+            name='is_public',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='is_deleted',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='status',
+            field=models.CharField(choices=[('DONE', 'Выполнено'), ('IN_PROGRESS', 'В процессе'), ('CANCELLED', 'Отменено')], db_index=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.3 on 2026-10-19 11:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_closure(apps, schema_editor):
+    # До этой миграции папки были плоскими: каждой достаточно ссылки на саму себя
+    Folder = apps.get_model('todo', 'Folder')
+    FolderClosure = apps.get_model('todo', 'FolderClosure')
+    db_alias = schema_editor.connection.alias
+    FolderClosure.objects.using(db_alias).bulk_create(
+        (FolderClosure(ancestor_id=pk, descendant_id=pk, depth=0)
+         for pk in Folder.objects.using(db_alias).values_list('pk', flat=True).iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todo', '0004_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='todo.folder'),
+        ),
+        migrations.CreateModel(
+            name='FolderClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='todo.folder')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='todo.folder')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descendant', 'depth'], name='todo_folder_descend_b0eb57_idx')],
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(fill_closure, migrations.RunPython.noop),
+    ]
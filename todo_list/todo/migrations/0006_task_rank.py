@@ -0,0 +1,40 @@
+# Generated by Django 5.1.3 on 2026-10-19 11:54
+
+from django.conf import settings
+from django.db import migrations, models
+
+from todo.ranking import spread_ranks
+
+
+def fill_ranks(apps, schema_editor):
+    # Сохраняем порядок, в котором клиенты видели задачи: по времени создания
+    Task = apps.get_model('todo', 'Task')
+    db_alias = schema_editor.connection.alias
+    tasks = Task.objects.using(db_alias)
+    page_ids = tasks.exclude(page=None).values_list('page_id', flat=True).distinct()
+    for page_id in page_ids.iterator():
+        page_tasks = list(tasks.filter(page_id=page_id).order_by('created_at', 'id').only('id'))
+        for task, rank in zip(page_tasks, spread_ranks(len(page_tasks))):
+            task.rank = rank
+        tasks.bulk_update(page_tasks, ['rank'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todo', '0005_folder_closure'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='rank',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['page', 'rank'], name='todo_task_page_id_4cb1e0_idx'),
+        ),
+        migrations.RunPython(fill_ranks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.3 on 2026-10-19 12:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todo', '0011_copy_jobs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Сначала составные индексы, потом удаление одиночных - таблицы не остаются без индекса по user
+        migrations.AddIndex(
+            model_name='folderpermission',
+            index=models.Index(fields=['user', 'folder'], name='todo_folder_user_id_fa8bf4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pagepermission',
+            index=models.Index(fields=['user', 'page'], name='todo_pagepe_user_id_275db9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='taskpermission',
+            index=models.Index(fields=['user', 'task'], name='todo_taskpe_user_id_aa4180_idx'),
+        ),
+        migrations.AlterField(
+            model_name='folderpermission',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='pagepermission',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='taskpermission',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
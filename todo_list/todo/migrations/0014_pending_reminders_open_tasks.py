@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-19 12:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todo', '0013_shard_locations'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='task',
+            name='todo_task_reminder_idx',
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('is_deleted', False), ('remind_at__isnull', False), ('reminded_at__isnull', True), ('status', 'IN_PROGRESS')), fields=['remind_at'], name='todo_task_reminder_idx'),
+        ),
+    ]
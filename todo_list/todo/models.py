@@ -1,66 +1,222 @@
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, router, transaction
+from django.db.models import F, Q
 from django.contrib.auth.models import User
+from django.utils import timezone
+from .ranking import RANK_MAX_LENGTH, rank_after, spread_ranks
+from .signals import fields_updated
 
 
 class SoftDeletableModel(models.Model):
-    is_deleted = models.BooleanField(default=False)
+    is_deleted = models.BooleanField(default=False, db_index=True)
+    deleted_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         abstract = True  # Делает модель абстрактной
+        # Частичный индекс только по удаленным строкам - по нему архивация ищет старые записи
+        indexes = [
+            models.Index(fields=['deleted_at'], condition=Q(is_deleted=True),
+                         name='%(app_label)s_%(class)s_tombstone_idx'),
+        ]
 
     def delete(self, *args, **kwargs):
         self.is_deleted = True
-        self.save()
+        self.deleted_at = timezone.now()
+        self.save(update_fields=['is_deleted', 'deleted_at'])
+
+
+class VersionedModel(models.Model):
+    # Номер версии для оптимистичной блокировки: запись проходит, только если версия не изменилась
+    version = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        abstract = True
+
+    def save_changed(self, fields, expected_version):
+        # Один UPDATE только по изменившимся колонкам; False - строку успел изменить кто-то другой
+        values = {}
+        for name in fields:
+            attname = self._meta.get_field(name).attname
+            values[attname] = getattr(self, attname)
+        for field in self._meta.concrete_fields:
+            if getattr(field, 'auto_now', False):
+                values[field.attname] = timezone.now()
+                setattr(self, field.attname, values[field.attname])
+        updated = type(self)._base_manager.filter(pk=self.pk, version=expected_version).update(
+            version=F('version') + 1, **values
+        )
+        if not updated:
+            return False
+        self.version = expected_version + 1
+        # post_save при UPDATE через queryset не отправляется
+        fields_updated.send(sender=type(self), instance=self, fields=list(fields), using=self._state.db)
+        return True
+
+
+class ArchiveModel(models.Model):
+    # Копия жестко удаленной строки: значения полей и выданные на нее права
+    original_id = models.BigIntegerField(unique=True)
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    permissions = models.JSONField(encoder=DjangoJSONEncoder, default=list)
+    deleted_at = models.DateTimeField(db_index=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        abstract = True
 
 
 class FolderPermission(models.Model):
     folder = models.ForeignKey('Folder', on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     can_view = models.BooleanField(default=False)
     can_edit = models.BooleanField(default=False)
     can_delete = models.BooleanField(default=False)
 
     class Meta:
         unique_together = ('folder', 'user')
+        indexes = [
+            # Объекты, выданные пользователю: заменяет одиночный индекс по user
+            models.Index(fields=['user', 'folder']),
+        ]
 
 
 class PagePermission(models.Model):
     page = models.ForeignKey('Page', on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     can_view = models.BooleanField(default=False)
     can_edit = models.BooleanField(default=False)
     can_delete = models.BooleanField(default=False)
 
     class Meta:
         unique_together = ('page', 'user')
+        indexes = [
+            models.Index(fields=['user', 'page']),
+        ]
 
 
 class TaskPermission(models.Model):
     task = models.ForeignKey('Task', on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     can_view = models.BooleanField(default=False)
     can_edit = models.BooleanField(default=False)
     can_delete = models.BooleanField(default=False)
 
     class Meta:
         unique_together = ('task', 'user')
+        indexes = [
+            models.Index(fields=['user', 'task']),
+        ]
+
+
+class FolderClosure(models.Model):
+    # Таблица замыкания: по строке на каждую пару (предок, потомок), включая саму папку с depth=0
+    ancestor = models.ForeignKey('Folder', on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey('Folder', on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+        indexes = [
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    @classmethod
+    def accessible_folder_ids(cls, user):
+        # Папки, права на которые пользователь имеет напрямую или унаследовал от предка
+        return cls.objects.filter(
+            Q(ancestor__owner=user) | Q(ancestor__permissions=user)
+        ).values('descendant')
+
+    @classmethod
+    def insert_node(cls, folder):
+        objects = cls.objects.db_manager(folder._state.db)
+        links = [cls(ancestor_id=folder.pk, descendant_id=folder.pk, depth=0)]
+        if folder.parent_id:
+            links += [
+                cls(ancestor_id=ancestor_id, descendant_id=folder.pk, depth=depth + 1)
+                for ancestor_id, depth in objects.filter(
+                    descendant_id=folder.parent_id
+                ).values_list('ancestor_id', 'depth')
+            ]
+        objects.bulk_create(links)
+
+    @classmethod
+    def move_subtree(cls, folder, batch_size=1000):
+        objects = cls.objects.db_manager(folder._state.db)
+        subtree = objects.filter(ancestor_id=folder.pk).values('descendant')
+        # Отрываем поддерево от старых предков одним DELETE
+        objects.filter(descendant__in=subtree).exclude(ancestor__in=subtree).delete()
+        if not folder.parent_id:
+            return
+        ancestors = list(objects.filter(
+            descendant_id=folder.parent_id
+        ).values_list('ancestor_id', 'depth'))
+        descendants = list(objects.filter(
+            ancestor_id=folder.pk
+        ).values_list('descendant_id', 'depth'))
+        objects.bulk_create(
+            (
+                cls(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=up + down + 1)
+                for ancestor_id, up in ancestors
+                for descendant_id, down in descendants
+            ),
+            batch_size=batch_size,
+        )
 
 
 class Folder(SoftDeletableModel, models.Model):
     name = models.CharField(unique=True, max_length=50)
+    parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE,
+                               related_name='children')
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='folder_owner')
-    is_public = models.BooleanField(default=False)
+    is_public = models.BooleanField(default=False, db_index=True)
     permissions = models.ManyToManyField(User, through='FolderPermission', blank=True,
                                          related_name='folder_permissions')
 
+    _loaded_parent_id = None
+
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_parent_id = instance.__dict__.get('parent_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+            if created:
+                FolderClosure.insert_node(self)
+            elif self.parent_id != self._loaded_parent_id:
+                FolderClosure.move_subtree(self)
+        self._loaded_parent_id = self.parent_id
+
+    def subtree_ids(self):
+        return FolderClosure.objects.using(self._state.db).filter(ancestor_id=self.pk).values('descendant')
+
+    def subtree_pages(self):
+        return Page.objects.using(self._state.db).filter(folder__in=self.subtree_ids())
+
+    def subtree_tasks(self):
+        return Task.objects.using(self._state.db).filter(page__folder__in=self.subtree_ids())
+
+    def is_in_subtree_of(self, folder):
+        return FolderClosure.objects.using(self._state.db).filter(
+            ancestor_id=folder.pk, descendant_id=self.pk
+        ).exists()
+
+    def user_has_access(self, user):
+        return FolderClosure.accessible_folder_ids(user).using(self._state.db).filter(descendant_id=self.pk).exists()
+
 
-class Page(SoftDeletableModel, models.Model):
+class Page(SoftDeletableModel, VersionedModel, models.Model):
     name = models.CharField(unique=True, max_length=50)
     folder = models.ForeignKey(Folder, on_delete=models.SET_NULL, null=True)
-    is_public = models.BooleanField(default=False)
+    is_public = models.BooleanField(default=False, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_page')
@@ -71,7 +227,7 @@ class Page(SoftDeletableModel, models.Model):
         return self.name
 
 
-class Task(SoftDeletableModel, models.Model):
+class Task(SoftDeletableModel, VersionedModel, models.Model):
     text = models.TextField(max_length=255)
     page = models.ForeignKey(Page, on_delete=models.SET_NULL, null=True)
     STATUS_CHOICES = (
@@ -79,7 +235,7 @@ class Task(SoftDeletableModel, models.Model):
         ('IN_PROGRESS', 'В процессе'),
         ('CANCELLED', 'Отменено'),
     )
-    status = models.CharField(choices=STATUS_CHOICES)
+    status = models.CharField(choices=STATUS_CHOICES, db_index=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='task_user')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -87,6 +243,139 @@ class Task(SoftDeletableModel, models.Model):
     updated_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='updated_task')
     previous_version = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE)
     permissions = models.ManyToManyField(User, through='TaskPermission', blank=True, related_name='task_permissions')
+    rank = models.CharField(max_length=64, default='', blank=True)
+    due_at = models.DateTimeField(null=True, blank=True)
+    remind_at = models.DateTimeField(null=True, blank=True)
+    reminded_at = models.DateTimeField(null=True, blank=True)
+
+    OPEN_STATUS = 'IN_PROGRESS'
+
+    class Meta(SoftDeletableModel.Meta):
+        indexes = SoftDeletableModel.Meta.indexes + [
+            models.Index(fields=['page', 'rank']),
+            # Частичные индексы: в них попадают только задачи со сроком или с ожидающим напоминанием
+            models.Index(fields=['due_at'], name='todo_task_due_idx',
+                         condition=Q(is_deleted=False, due_at__isnull=False)),
+            models.Index(fields=['due_at'], name='todo_task_open_due_idx',
+                         condition=Q(is_deleted=False, status='IN_PROGRESS', due_at__isnull=False)),
+            models.Index(fields=['remind_at'], name='todo_task_reminder_idx',
+                         condition=Q(is_deleted=False, status='IN_PROGRESS', reminded_at__isnull=True,
+                                     remind_at__isnull=False)),
+        ]
+
+    _loaded_remind_at = None
 
     def __str__(self):
         return self.text
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_remind_at = instance.__dict__.get('remind_at')
+        return instance
+
+    @classmethod
+    def pending_reminders(cls):
+        # Напоминания закрытых задач не срабатывают и в колесо не грузятся; при возврате задачи
+        # в работу post_save добавит ее в очередь ReminderChange
+        return cls.objects.filter(is_deleted=False, status=cls.OPEN_STATUS, reminded_at=None, remind_at__isnull=False)
+
+    @classmethod
+    def last_rank(cls, page_id):
+        return cls.objects.filter(page_id=page_id).order_by('-rank').values_list('rank', flat=True).first()
+
+    @classmethod
+    def rank_at_end(cls, page_id):
+        rank = rank_after(cls.last_rank(page_id))
+        if len(rank) > RANK_MAX_LENGTH:
+            # Ключи в конце страницы исчерпались - перенумеровываем ее и берем ключ заново
+            cls.rebalance_ranks(page_id)
+            rank = rank_after(cls.last_rank(page_id))
+        return rank
+
+    @classmethod
+    def rebalance_ranks(cls, page_id, batch_size=1000):
+        with transaction.atomic(using=router.db_for_write(cls)):
+            tasks = list(cls.objects.select_for_update().filter(page_id=page_id).order_by('rank', 'id').only('id', 'rank'))
+            for task, rank in zip(tasks, spread_ranks(len(tasks))):
+                task.rank = rank
+            cls.objects.bulk_update(tasks, ['rank'], batch_size=batch_size)
+        return len(tasks)
+
+
+class FolderArchive(ArchiveModel):
+    pass
+
+
+class PageArchive(ArchiveModel):
+    pass
+
+
+class TaskArchive(ArchiveModel):
+    pass
+
+
+class ReminderChange(models.Model):
+    # Очередь изменений напоминаний для планировщика (см. todo.reminders); task_id без внешнего ключа,
+    # чтобы запись переживала удаление задачи
+    task_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class CopyJob(models.Model):
+    # Копирование большого поддерева, отложенное до команды run_copy_jobs (см. todo.copying)
+    KIND_CHOICES = (
+        ('folder', 'Папка'),
+        ('page', 'Страница'),
+    )
+    STATUS_CHOICES = (
+        ('PENDING', 'В очереди'),
+        ('RUNNING', 'Выполняется'),
+        ('DONE', 'Готово'),
+        ('FAILED', 'Ошибка'),
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    source_id = models.BigIntegerField()
+    # Папка, в которую копируем; None - копия папки становится корневой
+    target_id = models.BigIntegerField(null=True, blank=True)
+    name = models.CharField(max_length=255, blank=True)
+    with_permissions = models.BooleanField(default=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='copy_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING', db_index=True)
+    result_id = models.BigIntegerField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.kind} {self.source_id}: {self.status}'
+
+
+class ShardAssignment(models.Model):
+    # Каталог шардов: на каком шарде создаются корневые папки пользователя (см. todo.sharding)
+    owner = models.OneToOneField(User, on_delete=models.CASCADE, related_name='shard_assignment')
+    shard = models.CharField(max_length=100, db_index=True)
+
+    def __str__(self):
+        return f'{self.owner_id} -> {self.shard}'
+
+
+class IdSequence(models.Model):
+    # Счетчик id модели на своем шарде - для баз без последовательностей (на PostgreSQL id берутся
+    # из последовательности таблицы, см. todo.sharding.allocate_ids)
+    name = models.CharField(max_length=100, unique=True)
+    last_value = models.BigIntegerField(default=0)
+
+
+class ShardLocation(models.Model):
+    # Каталог: шард объекта, если он не следует из id - объект перенесен move_owner
+    # или получил id до включения шардирования
+    model = models.CharField(max_length=100)
+    object_id = models.BigIntegerField()
+    shard = models.CharField(max_length=100)
+
+    class Meta:
+        unique_together = ('model', 'object_id')
+
+    def __str__(self):
+        return f'{self.model} {self.object_id} -> {self.shard}'
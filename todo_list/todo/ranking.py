@@ -0,0 +1,58 @@
+# Ключи порядка задач - дробная часть числа в base-36, записанная строкой.
+# Алфавит из цифр и строчных латинских букв сортируется одинаково в любой
+# коллации, поэтому сравнение строк в БД совпадает с числовым.
+# Ключ никогда не оканчивается на '0', иначе между 'a' и 'a0' не нашлось бы места.
+
+RANK_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+RANK_BASE = len(RANK_DIGITS)
+RANK_MAX_LENGTH = 64
+# Страницы с ключами длиннее этого порога пора перенумеровать
+RANK_REBALANCE_LENGTH = 32
+
+
+def rank_between(before, after):
+    # Ключ строго между before и after; None означает начало или конец списка
+    before = before or ''
+    if after is not None and after <= before:
+        raise ValueError('Ключ after должен быть больше before')
+    result = ''
+    i = 0
+    while True:
+        low = RANK_DIGITS.index(before[i]) if i < len(before) else 0
+        high = RANK_DIGITS.index(after[i]) if after is not None and i < len(after) else RANK_BASE
+        if high - low > 1:
+            return result + RANK_DIGITS[(low + high) // 2]
+        result += RANK_DIGITS[low]
+        if high - low == 1:
+            # Префикс уже меньше after, дальше верхней границы нет
+            after = None
+        i += 1
+
+
+def rank_after(before):
+    # Ключ для добавления в конец: следующая цифра в первом разряде, где она есть ('i' -> 'j', 'z' -> 'z1').
+    # Длина растет раз в 35 добавлений, а не каждые несколько, как у rank_between(before, None)
+    if not before:
+        return rank_between(None, None)
+    for i, digit in enumerate(before):
+        position = RANK_DIGITS.index(digit)
+        if position < RANK_BASE - 1:
+            return before[:i] + RANK_DIGITS[position + 1]
+    return before + RANK_DIGITS[1]
+
+
+def spread_ranks(count):
+    # count равномерно распределенных ключей одинаковой длины
+    width = 1
+    while RANK_BASE ** width <= count:
+        width += 1
+    step = RANK_BASE ** width // (count + 1)
+    ranks = []
+    for i in range(1, count + 1):
+        value = i * step
+        digits = []
+        for _ in range(width):
+            value, digit = divmod(value, RANK_BASE)
+            digits.append(RANK_DIGITS[digit])
+        ranks.append(''.join(reversed(digits)).rstrip('0'))
+    return ranks
@@ -0,0 +1,182 @@
+import math
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import router, transaction
+from django.utils import timezone
+
+from . import sharding
+from .models import ReminderChange, Task
+from .signals import reminders_due
+
+# Планировщик напоминаний держит в памяти ближайшие напоминания в колесе таймеров и не опрашивает
+# таблицу задач целиком: из базы читается только следующее окно по индексу remind_at и очередь
+# ReminderChange, которую пополняют сигналы изменения задач.
+
+
+class TimerWheel:
+    # Кольцо из slots ячеек по tick секунд: добавление, удаление и срабатывание - O(1) на таймер.
+    # Таймеры дальше горизонта (tick * slots) не принимаются, их подгружает планировщик позже.
+
+    def __init__(self, tick, slots, now):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.positions = {}
+        self.current = self._tick_of(now)
+
+    def _tick_of(self, moment):
+        return math.floor(moment.timestamp() / self.tick)
+
+    @property
+    def horizon(self):
+        return datetime.fromtimestamp((self.current + len(self.slots)) * self.tick, tz=dt_timezone.utc)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def add(self, key, when):
+        self.remove(key)
+        position = max(self._tick_of(when), self.current)
+        if position >= self.current + len(self.slots):
+            return False
+        self.slots[position % len(self.slots)][key] = position
+        self.positions[key] = position
+        return True
+
+    def remove(self, key):
+        position = self.positions.pop(key, None)
+        if position is not None:
+            self.slots[position % len(self.slots)].pop(key, None)
+
+    def advance(self, now):
+        # Возвращает ключи всех таймеров, время которых наступило к now
+        target = self._tick_of(now)
+        fired = []
+        for position in range(self.current, min(target + 1, self.current + len(self.slots))):
+            slot = self.slots[position % len(self.slots)]
+            for key, due in list(slot.items()):
+                if due <= target:
+                    fired.append(key)
+                    del slot[key]
+                    del self.positions[key]
+        self.current = max(self.current, target + 1)
+        return fired
+
+
+class ReminderScheduler:
+    # Один экземпляр на шард: вызовы должны идти внутри sharding.use_shard(shard)
+
+    def __init__(self, tick=1, slots=3600, batch_size=500, now=None):
+        now = now or timezone.now()
+        self.wheel = TimerWheel(tick, slots, now)
+        self.batch_size = batch_size
+        self.loaded_until = now
+        self.loaded = False
+
+    def load(self):
+        # Подгружает напоминания, вошедшие в горизонт колеса; на первом запуске - и все просроченные
+        until = self.wheel.horizon
+        queryset = Task.pending_reminders().filter(remind_at__lt=until)
+        if self.loaded:
+            queryset = queryset.filter(remind_at__gte=self.loaded_until)
+        for pk, remind_at in queryset.values_list('pk', 'remind_at').iterator():
+            self.wheel.add(pk, remind_at)
+        self.loaded_until = until
+        self.loaded = True
+
+    def apply_changes(self):
+        # Без отсечки по id: запись с меньшим id может стать видна позже (транзакция закоммитилась
+        # после соседней), поэтому каждый цикл читает то, что осталось в очереди
+        changes = list(ReminderChange.objects.order_by('pk').values_list('pk', 'task_id')[:self.batch_size])
+        if not changes:
+            return 0
+        task_ids = {task_id for _, task_id in changes}
+        pending = dict(Task.pending_reminders().filter(pk__in=task_ids, remind_at__lt=self.loaded_until)
+                       .values_list('pk', 'remind_at'))
+        for task_id in task_ids:
+            if task_id in pending:
+                self.wheel.add(task_id, pending[task_id])
+            else:
+                self.wheel.remove(task_id)
+        # Удаляются ровно прочитанные записи. Несколько планировщиков на одном шарде не предусмотрены
+        ReminderChange.objects.filter(pk__in=[pk for pk, _ in changes]).delete()
+        return len(changes)
+
+    def fire(self, task_ids, now):
+        fired = 0
+        for start in range(0, len(task_ids), self.batch_size):
+            fired += fire_reminders(task_ids[start:start + self.batch_size], now)
+        return fired
+
+    def run_once(self, now=None):
+        now = now or timezone.now()
+        if not self.loaded:
+            self.load()
+        self.apply_changes()
+        due = self.wheel.advance(now)
+        if self.wheel.horizon - self.loaded_until > self.wheel_span() / 4:
+            # Колесо ушло вперед - подгружаем следующий участок; напоминания, наступившие
+            # за время простоя планировщика, сработают на следующем такте
+            self.load()
+        return self.fire(due, now)
+
+    def wheel_span(self):
+        return timedelta(seconds=self.wheel.tick * len(self.wheel.slots))
+
+
+def fire_reminders(task_ids, now):
+    # Одна транзакция на пачку: повторная проверка условий отсекает задачи, измененные после загрузки
+    # в колесо (выполнены, удалены, напоминание перенесено)
+    with transaction.atomic(using=router.db_for_write(Task)):
+        tasks = list(
+            Task.pending_reminders().select_for_update(skip_locked=True)
+            .filter(pk__in=task_ids, remind_at__lte=now)
+        )
+        if not tasks:
+            return 0
+        Task.objects.filter(pk__in=[task.pk for task in tasks]).update(reminded_at=now)
+        using = router.db_for_write(Task)
+        transaction.on_commit(lambda: reminders_due.send(sender=Task, tasks=tasks, using=using), using=using)
+    return len(tasks)
+
+
+def record_change(sender, instance, using, raw=False, **kwargs):
+    # post_save задачи: в очередь попадают только задачи, у которых напоминание есть или было
+    if raw or (instance.remind_at is None and instance._loaded_remind_at is None):
+        return
+    ReminderChange.objects.using(using).create(task_id=instance.pk)
+    instance._loaded_remind_at = instance.remind_at
+
+
+def record_changes(tasks):
+    # Массовый .update() задач проходит мимо сигналов: очередь пополняется явно, до изменения строк
+    task_ids = list(tasks.filter(remind_at__isnull=False).values_list('pk', flat=True))
+    ReminderChange.objects.using(tasks.db).bulk_create([ReminderChange(task_id=pk) for pk in task_ids])
+
+
+def record_fields_change(sender, instance, fields, using, **kwargs):
+    # Срабатывание зависит и от статуса: напоминание задачи, возвращенной в работу, снова ждет очереди
+    if 'remind_at' in fields or ('status' in fields and instance.remind_at is not None):
+        ReminderChange.objects.using(using).create(task_id=instance.pk)
+        instance._loaded_remind_at = instance.remind_at
+
+
+def run_schedulers(shards=None, tick=1, slots=3600, batch_size=500, once=False, on_fired=None):
+    # Цикл планировщика: по колесу на каждый шард
+    shards = shards or sharding.get_shards()
+    schedulers = {}
+    for shard in shards:
+        with sharding.use_shard(shard):
+            schedulers[shard] = ReminderScheduler(tick=tick, slots=slots, batch_size=batch_size)
+    while True:
+        for shard, scheduler in schedulers.items():
+            with sharding.use_shard(shard):
+                fired = scheduler.run_once()
+            if fired and on_fired:
+                on_fired(shard, fired)
+        if once:
+            return
+        time.sleep(tick)
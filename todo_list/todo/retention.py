@@ -0,0 +1,253 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, router, transaction
+from django.db.models import Exists, OuterRef
+from django.http import Http404
+from django.utils import timezone
+from rest_framework import serializers
+
+from . import reminders, sharding
+from .models import (Folder, Page, Task, FolderPermission, PagePermission, TaskPermission,
+                     FolderArchive, PageArchive, TaskArchive)
+
+DEFAULT_RETENTION = {
+    'ARCHIVE_AFTER_DAYS': 30,
+    'PURGE_AFTER_DAYS': 365,
+    'BATCH_SIZE': 1000,
+}
+
+# Порядок важен: сначала задачи, потом страницы, потом папки,
+# чтобы родитель уходил в архив только после всех своих детей
+ARCHIVE_POLICIES = {
+    Task: {
+        'archive': TaskArchive,
+        'permission': TaskPermission,
+        'permission_field': 'task',
+        'parent_field': 'page',
+    },
+    Page: {
+        'archive': PageArchive,
+        'permission': PagePermission,
+        'permission_field': 'page',
+        'parent_field': 'folder',
+    },
+    Folder: {
+        'archive': FolderArchive,
+        'permission': FolderPermission,
+        'permission_field': 'folder',
+        'parent_field': 'parent',
+    },
+}
+
+PERMISSION_FIELDS = ('user_id', 'can_view', 'can_edit', 'can_delete')
+
+
+def get_retention_settings():
+    return {**DEFAULT_RETENTION, **getattr(settings, 'TODO_RETENTION', {})}
+
+
+def archivable(model, cutoff):
+    queryset = model.objects.filter(is_deleted=True, deleted_at__lt=cutoff)
+    # Пропускаем строки, на которые еще ссылаются оставшиеся в таблицах записи
+    if model is Task:
+        queryset = queryset.exclude(Exists(Task.objects.filter(previous_version=OuterRef('pk'))))
+    elif model is Page:
+        queryset = queryset.exclude(Exists(Task.objects.filter(page=OuterRef('pk'))))
+    elif model is Folder:
+        queryset = queryset.exclude(Exists(Folder.objects.filter(parent=OuterRef('pk')))) \
+            .exclude(Exists(Page.objects.filter(folder=OuterRef('pk'))))
+    return queryset
+
+
+def serialize_row(obj):
+    return {field.attname: field.value_from_object(obj) for field in obj._meta.concrete_fields}
+
+
+def archive_batch(model, cutoff, batch_size):
+    policy = ARCHIVE_POLICIES[model]
+    ids = list(archivable(model, cutoff).order_by('pk').values_list('pk', flat=True)[:batch_size])
+    if not ids:
+        return 0
+
+    # Каждая пачка - отдельная транзакция: прерванный запуск продолжается со следующей
+    with transaction.atomic(using=router.db_for_write(model)):
+        # Условия archivable повторяются под блокировкой: пока выбирались id, строку могли восстановить
+        # или сослаться на нее, а delete() ниже каскадом удалил бы новых детей
+        rows = list(archivable(model, cutoff).select_for_update().filter(pk__in=ids))
+        row_ids = [row.pk for row in rows]
+        grants = {}
+        for grant in policy['permission'].objects.filter(**{f"{policy['permission_field']}_id__in": row_ids}):
+            grants.setdefault(getattr(grant, f"{policy['permission_field']}_id"), []).append(
+                {field: getattr(grant, field) for field in PERMISSION_FIELDS}
+            )
+        policy['archive'].objects.bulk_create([
+            policy['archive'](
+                original_id=row.pk,
+                data=serialize_row(row),
+                permissions=grants.get(row.pk, []),
+                deleted_at=row.deleted_at,
+            )
+            for row in rows
+        ])
+        model.objects.filter(pk__in=row_ids).delete()
+    return len(rows)
+
+
+def purge_batch(archive_model, cutoff, batch_size):
+    ids = list(archive_model.objects.filter(deleted_at__lt=cutoff)
+               .order_by('pk').values_list('pk', flat=True)[:batch_size])
+    if ids:
+        archive_model.objects.filter(pk__in=ids).delete()
+    return len(ids)
+
+
+def run_retention(archive_after_days=None, purge_after_days=None, batch_size=None, max_batches=None):
+    options = get_retention_settings()
+    if archive_after_days is None:
+        archive_after_days = options['ARCHIVE_AFTER_DAYS']
+    if purge_after_days is None:
+        purge_after_days = options['PURGE_AFTER_DAYS']
+    if batch_size is None:
+        batch_size = options['BATCH_SIZE']
+
+    now = timezone.now()
+    archive_cutoff = now - timedelta(days=archive_after_days)
+    purge_cutoff = now - timedelta(days=purge_after_days)
+    batches = 0
+    stats = {}
+
+    def budget_left():
+        return max_batches is None or batches < max_batches
+
+    for shard in sharding.get_shards():
+        with sharding.use_shard(shard):
+            for model, policy in ARCHIVE_POLICIES.items():
+                counts = stats.setdefault(model._meta.model_name, {'archived': 0, 'purged': 0})
+                while budget_left():
+                    count = archive_batch(model, archive_cutoff, batch_size)
+                    if not count:
+                        break
+                    counts['archived'] += count
+                    batches += 1
+                while budget_left():
+                    count = purge_batch(policy['archive'], purge_cutoff, batch_size)
+                    if not count:
+                        break
+                    counts['purged'] += count
+                    batches += 1
+    return stats
+
+
+def restore(model, pk, check_permission):
+    # Восстанавливает запись: мягко удаленную - на месте, жестко удаленную - из архива
+    policy = ARCHIVE_POLICIES[model]
+    using = router.db_for_write(model)
+    with transaction.atomic(using=using):
+        tombstone = model.objects.filter(pk=pk, is_deleted=True).first()
+        if tombstone is not None:
+            check_permission(tombstone)
+            deleted_at = tombstone.deleted_at
+            tombstone.is_deleted = False
+            tombstone.deleted_at = None
+            tombstone.save(update_fields=['is_deleted', 'deleted_at'])
+            if model is Folder:
+                restore_subtree(tombstone, deleted_at)
+            return tombstone
+
+        archived = policy['archive'].objects.select_for_update().filter(original_id=pk).first()
+        if archived is None:
+            raise Http404
+        instance = from_archive(model, archived)
+        check_permission(instance)
+        insert_restored(model, instance, archived, using)
+        if model is Folder:
+            restore_subtree(instance, archived.deleted_at)
+    return instance
+
+
+def from_archive(model, archived):
+    policy = ARCHIVE_POLICIES[model]
+    values = {}
+    for field in model._meta.concrete_fields:
+        if field.attname in archived.data:
+            values[field.attname] = field.to_python(archived.data[field.attname])
+    instance = model(**values)
+    instance.is_deleted = False
+    instance.deleted_at = None
+
+    parent_field = model._meta.get_field(policy['parent_field'])
+    parent_id = getattr(instance, parent_field.attname)
+    if parent_id is not None and not parent_field.related_model.objects.filter(pk=parent_id).exists():
+        raise serializers.ValidationError(
+            {policy['parent_field']: "Сначала восстановите родительский объект"}
+        )
+    if model is Task and instance.previous_version_id is not None \
+            and not Task.objects.filter(pk=instance.previous_version_id).exists():
+        # Предыдущая версия уже удалена окончательно
+        instance.previous_version_id = None
+    return instance
+
+
+def insert_restored(model, instance, archived, using):
+    policy = ARCHIVE_POLICIES[model]
+    try:
+        with transaction.atomic(using=using):
+            instance.save(force_insert=True, using=using)
+    except IntegrityError:
+        raise serializers.ValidationError("Не удалось восстановить запись: конфликт с существующими данными")
+
+    # auto_now_add/auto_now перезаписали время при вставке - возвращаем исходное
+    timestamps = {name: archived.data[name] for name in ('created_at', 'updated_at') if name in archived.data}
+    if timestamps:
+        model.objects.filter(pk=instance.pk).update(**{
+            name: model._meta.get_field(name).to_python(value) for name, value in timestamps.items()
+        })
+
+    existing_users = set(User.objects.filter(
+        pk__in=[grant['user_id'] for grant in archived.permissions]
+    ).values_list('pk', flat=True))
+    policy['permission'].objects.bulk_create([
+        policy['permission'](**{policy['permission_field']: instance}, **grant)
+        for grant in archived.permissions if grant['user_id'] in existing_users
+    ], ignore_conflicts=True)
+    archived.delete()
+
+
+def restore_archived_children(model, parent_ids, deleted_at, using):
+    # Архивные строки, удаленные вместе с родителем (тот же deleted_at) - по индексу на deleted_at
+    policy = ARCHIVE_POLICIES[model]
+    parent_attname = model._meta.get_field(policy['parent_field']).attname
+    restored = []
+    for archived in policy['archive'].objects.select_for_update().filter(deleted_at=deleted_at) \
+            .order_by('original_id'):
+        if archived.data.get(parent_attname) in parent_ids:
+            instance = from_archive(model, archived)
+            insert_restored(model, instance, archived, using)
+            restored.append(instance.pk)
+    return restored
+
+
+def restore_subtree(folder, deleted_at):
+    # FolderViewSet.destroy помечает все поддерево одним deleted_at: возвращаем вместе с папкой
+    # то, что удалялось вместе с ней; удаленное раньше по отдельности остается удаленным
+    using = folder._state.db
+    tombstones = Folder.objects.filter(id__in=folder.subtree_ids(), is_deleted=True, deleted_at=deleted_at)
+    folder_ids = {folder.pk} | set(tombstones.values_list('pk', flat=True))
+    tombstones.update(is_deleted=False, deleted_at=None)
+    # Папки из архива - сверху вниз: при вставке родитель уже должен быть в таблице
+    parents = folder_ids
+    while parents:
+        parents = set(restore_archived_children(Folder, parents, deleted_at, using))
+        folder_ids |= parents
+
+    Page.objects.filter(folder_id__in=folder_ids, is_deleted=True, deleted_at=deleted_at) \
+        .update(is_deleted=False, deleted_at=None)
+    restore_archived_children(Page, folder_ids, deleted_at, using)
+
+    page_ids = set(Page.objects.filter(folder_id__in=folder_ids, is_deleted=False).values_list('pk', flat=True))
+    tasks = Task.objects.filter(page_id__in=page_ids, is_deleted=True, deleted_at=deleted_at)
+    reminders.record_changes(tasks)
+    tasks.update(is_deleted=False, deleted_at=None)
+    restore_archived_children(Task, page_ids, deleted_at, using)
@@ -1,8 +1,79 @@
-from rest_framework import serializers
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException
 from .models import *
 from django.urls import reverse
 
 
+class VersionConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "Объект уже изменен другим пользователем. Обновите данные и повторите."
+    default_code = 'version_conflict'
+
+
+class VersionedSerializerMixin:
+    # Обновляет только изменившиеся поля и сверяет версию: из поля version или заголовка If-Match
+
+    def get_expected_version(self, instance, validated_data):
+        version = validated_data.pop('version', None)
+        if version is not None:
+            return version
+        request = self.context.get('request')
+        if_match = request.headers.get('If-Match') if request else None
+        if if_match:
+            try:
+                return int(if_match.strip('W/').strip('"'))
+            except ValueError:
+                raise serializers.ValidationError({"version": "Некорректный заголовок If-Match"})
+        return instance.version
+
+    def create(self, validated_data):
+        validated_data.pop('version', None)
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        expected_version = self.get_expected_version(instance, validated_data)
+        if expected_version != instance.version:
+            raise VersionConflict()
+
+        changed = []
+        for name, value in validated_data.items():
+            field = instance._meta.get_field(name)
+            if field.is_relation:
+                current, new = getattr(instance, field.attname), getattr(value, 'pk', None)
+            else:
+                current, new = getattr(instance, name), value
+            if current != new:
+                setattr(instance, name, value)
+                changed.append(name)
+
+        if changed and not instance.save_changed(changed, expected_version):
+            raise VersionConflict()
+        return instance
+
+
+class IncludeSerializerMixin:
+    # Встраивает коллекции, подгруженные вьюсетом в атрибуты included_<name> (см. ?include=)
+
+    def get_include_serializers(self):
+        return {}
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        limit = self.context.get('include_limit')
+        # Встраиваем только на верхнем уровне ответа, вложенные объекты отдаются как есть
+        if limit is None or self.context.get('embedded'):
+            return data
+        context = {**self.context, 'embedded': True}
+        for name, serializer_class in self.get_include_serializers().items():
+            items = getattr(instance, f'included_{name}', None)
+            if items is None:
+                continue
+            # Вьюсет подгружает limit + 1 строку, чтобы понять, есть ли продолжение
+            data[name] = serializer_class(items[:limit], many=True, context=context).data
+            data[f'{name}_has_more'] = len(items) > limit
+        return data
+
+
 class FolderPermissionSerializer(serializers.ModelSerializer):
     class Meta:
         model = FolderPermission
@@ -45,26 +116,45 @@ class TaskPermissionSerializer(serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
 
 
-class FolderSerializer(serializers.ModelSerializer):
+class FolderSerializer(IncludeSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Folder
-        fields = ('id', 'name', 'owner', 'owner_name', 'is_public')
+        fields = ('id', 'name', 'parent', 'owner', 'owner_name', 'is_public')
         extra_kwargs = {
             'owner': {'read_only': True},
             'owner_name': {'read_only': True}
         }
 
     name = serializers.CharField(max_length=255)
+    parent = serializers.PrimaryKeyRelatedField(queryset=Folder.objects.filter(is_deleted=False),
+                                                required=False, allow_null=True)
     owner_name = serializers.SerializerMethodField()
 
     def get_owner_name(self, obj):
         return obj.owner.username
 
+    def validate_parent(self, value):
+        if value is None:
+            return value
+        if self.instance and value.is_in_subtree_of(self.instance):
+            raise serializers.ValidationError("Нельзя переместить папку внутрь самой себя.")
+        request = self.context.get('request')
+        if request and not value.user_has_access(request.user):
+            raise serializers.ValidationError("У вас нет прав на эту папку.")
+        return value
+
+    def get_include_serializers(self):
+        return {
+            'pages': PageSerializer,
+            'children': FolderSerializer,
+            'permissions': FolderPermissionSerializer,
+        }
+
 
-class PageSerializer(serializers.ModelSerializer):
+class PageSerializer(VersionedSerializerMixin, IncludeSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Page
-        fields = ('id', 'name', 'folder', 'folder_data', 'is_public', 'created_at',
+        fields = ('id', 'name', 'folder', 'folder_data', 'is_public', 'version', 'created_at',
                   'updated_at', 'created_by', 'updated_by')
         extra_kwargs = {
             'name': {'required': True},
@@ -75,6 +165,7 @@ class PageSerializer(serializers.ModelSerializer):
     created_by = serializers.PrimaryKeyRelatedField(read_only=True)
     updated_by = serializers.PrimaryKeyRelatedField(read_only=True)
     folder_data = serializers.SerializerMethodField()
+    version = serializers.IntegerField(required=False, min_value=1)
     created_at = serializers.DateTimeField(read_only=True, format='%d-%m-%Y %H:%M:%S')
     updated_at = serializers.DateTimeField(read_only=True, format='%d-%m-%Y %H:%M:%S')
 
@@ -82,18 +173,28 @@ class PageSerializer(serializers.ModelSerializer):
         folder_serializer = FolderSerializer(instance=obj.folder)
         return folder_serializer.data
 
+    def get_include_serializers(self):
+        return {
+            'tasks': TaskSerializer,
+            'permissions': PagePermissionSerializer,
+        }
+
 
-class TaskSerializer(serializers.ModelSerializer):
+class TaskSerializer(VersionedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Task
-        fields = ('id', 'text', 'status', 'user', 'user_name', 'page', 'page_name', 'previous_version',
-                  'previous_version_url', 'created_at', 'updated_at', 'created_by', 'updated_by')
+        fields = ('id', 'text', 'status', 'user', 'user_name', 'page', 'page_name', 'rank', 'version',
+                  'due_at', 'remind_at', 'reminded_at', 'previous_version', 'previous_version_url',
+                  'created_at', 'updated_at', 'created_by', 'updated_by')
         extra_kwargs = {
             'text': {'required': True},
             'page': {'required': True},
+            'rank': {'read_only': True},
+            'reminded_at': {'read_only': True},
         }
 
     status = serializers.ChoiceField(choices=Task.STATUS_CHOICES)
+    version = serializers.IntegerField(required=False, min_value=1)
     created_by = serializers.PrimaryKeyRelatedField(read_only=True)
     updated_by = serializers.PrimaryKeyRelatedField(read_only=True)
     created_at = serializers.DateTimeField(read_only=True, format='%d-%m-%Y %H:%M:%S')
@@ -114,6 +215,56 @@ class TaskSerializer(serializers.ModelSerializer):
         return page_serializer.data
 
     def get_previous_version_url(self, obj):
-        if obj.previous_version:
-            return reverse('task-detail', args=[obj.previous_version.id])
+        if obj.previous_version_id:
+            return reverse('task-detail', args=[obj.previous_version_id])
         return None
+
+    def update(self, instance, validated_data):
+        # Новое время напоминания - напоминание снова ожидает отправки
+        if 'remind_at' in validated_data and validated_data['remind_at'] != instance.remind_at:
+            validated_data['reminded_at'] = None
+        return super().update(instance, validated_data)
+
+
+class CopyJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CopyJob
+        fields = ('id', 'kind', 'source_id', 'target_id', 'name', 'with_permissions', 'status', 'result_id',
+                  'error', 'created_at', 'finished_at')
+        read_only_fields = fields
+
+    created_at = serializers.DateTimeField(read_only=True, format='%d-%m-%Y %H:%M:%S')
+    finished_at = serializers.DateTimeField(read_only=True, format='%d-%m-%Y %H:%M:%S')
+
+
+class RevokeItemSerializer(serializers.Serializer):
+    # Ровно один объект из folder/page/task; на выходе {'kind', 'target', 'user', ...}
+    folder = serializers.IntegerField(required=False, min_value=1)
+    page = serializers.IntegerField(required=False, min_value=1)
+    task = serializers.IntegerField(required=False, min_value=1)
+    user = serializers.IntegerField(min_value=1)
+
+    def validate(self, attrs):
+        kinds = [kind for kind in ('folder', 'page', 'task') if kind in attrs]
+        if len(kinds) != 1:
+            raise serializers.ValidationError("Укажите ровно одно из полей folder, page или task")
+        kind = kinds[0]
+        return {'kind': kind, 'target': attrs.pop(kind), **attrs}
+
+
+class GrantItemSerializer(RevokeItemSerializer):
+    can_view = serializers.BooleanField(default=False)
+    can_edit = serializers.BooleanField(default=False)
+    can_delete = serializers.BooleanField(default=False)
+
+
+class PermissionBatchSerializer(serializers.Serializer):
+    grant = GrantItemSerializer(many=True, required=False)
+    revoke = RevokeItemSerializer(many=True, required=False)
+
+    def validate(self, attrs):
+        attrs.setdefault('grant', [])
+        attrs.setdefault('revoke', [])
+        if not attrs['grant'] and not attrs['revoke']:
+            raise serializers.ValidationError("Передайте grant или revoke")
+        return attrs
@@ -0,0 +1,400 @@
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections, connections, router, transaction
+from django.db.models import Count
+
+# Данные todo живут на нескольких базах (шардах). Поддерево папок целиком лежит на одном шарде:
+# корневая папка - на шарде своего владельца, вложенные - на шарде родителя, страницы, задачи и права -
+# рядом со своей папкой. Каталог (владелец -> шард, шарды перенесенных объектов) и пользователи живут в базе-каталоге,
+# пользователи дополнительно копируются на каждый шард, чтобы внешние ключи оставались внутри одной базы.
+
+# Модели каталога: строки только в базе-каталоге, на остальных шардах таблицы остаются пустыми
+DIRECTORY_MODELS = ('shardassignment', 'shardlocation')
+# Модели, id которых видны в API и должны быть уникальны между шардами
+GLOBAL_ID_MODELS = ('folder', 'page', 'task', 'folderpermission', 'pagepermission', 'taskpermission', 'copyjob')
+# id таких моделей кодирует шард: SHARD_ID_OFFSET + номер * SHARD_ID_STRIDE + индекс шарда в TODO_SHARDS,
+# поэтому новые шарды добавляются только в конец списка. id меньше SHARD_ID_OFFSET выданы до шардирования
+SHARD_ID_OFFSET = 1 << 40
+SHARD_ID_STRIDE = 1024
+# Служебные приложения, таблицы которых нужны на каждом шарде. admin и authtoken (как и каталог todo)
+# ссылаются на User: без их пустых таблиц каскадное удаление копии пользователя на шарде падает
+REPLICATED_APPS = ('auth', 'contenttypes', 'admin', 'authtoken')
+
+_current_shard = ContextVar('todo_shard', default=None)
+_executor = None
+_executor_size = 0
+_worker = threading.local()
+
+
+def get_shards():
+    return list(getattr(settings, 'TODO_SHARDS', ['default']))
+
+
+def get_directory_db():
+    return get_shards()[0]
+
+
+def is_sharded():
+    return len(get_shards()) > 1
+
+
+def is_sharded_model(model):
+    return model._meta.app_label == 'todo' and model._meta.model_name not in DIRECTORY_MODELS
+
+
+def current_shard():
+    return _current_shard.get()
+
+
+def current_db(model=None):
+    # База, в которую сейчас пишет код: для transaction.atomic(using=...)
+    if model is not None:
+        return router.db_for_write(model)
+    return current_shard() or get_directory_db()
+
+
+def activate(alias):
+    return _current_shard.set(alias)
+
+
+def deactivate(token):
+    _current_shard.reset(token)
+
+
+@contextmanager
+def use_shard(alias):
+    token = activate(alias)
+    try:
+        yield alias
+    finally:
+        deactivate(token)
+
+
+def get_executor(size):
+    # Пул потоков общий для всех вызовов: потоки и их соединения не создаются заново на каждый запрос
+    global _executor, _executor_size
+    if _executor is None or _executor_size < size:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor, _executor_size = ThreadPoolExecutor(max_workers=size, thread_name_prefix='todo-shard'), size
+    return _executor
+
+
+def run_on_shards(func, shards=None):
+    # Выполняет func(alias) на каждом шарде параллельно и возвращает {alias: результат}
+    shards = get_shards() if shards is None else shards
+    if len(shards) == 1 or getattr(_worker, 'active', False):
+        # Вызов из потока пула выполняется на месте: иначе занятый пул ждал бы сам себя
+        results = {}
+        for alias in shards:
+            with use_shard(alias):
+                results[alias] = func(alias)
+        return results
+
+    def worker(alias):
+        # Соединения потока закрываются по CONN_MAX_AGE, как в конце HTTP-запроса
+        close_old_connections()
+        _worker.active = True
+        try:
+            with use_shard(alias):
+                return func(alias)
+        finally:
+            _worker.active = False
+            close_old_connections()
+
+    return dict(zip(shards, get_executor(len(shards)).map(worker, shards)))
+
+
+def shard_of_id(pk):
+    # Шард, закодированный в id; None для id, выданных до шардирования
+    pk = int(pk)
+    if pk < SHARD_ID_OFFSET:
+        return None
+    shards = get_shards()
+    index = (pk - SHARD_ID_OFFSET) % SHARD_ID_STRIDE
+    return shards[index] if index < len(shards) else None
+
+
+def locate_shard(model, pk, archive_model=None):
+    # Шард, на котором лежит строка с данным id: запись каталога (перенесенные объекты), иначе шард из id.
+    # Шарды опрашиваются только для id, выданных до шардирования, найденный шард запоминается в каталоге
+    shards = get_shards()
+    if len(shards) == 1:
+        return shards[0]
+    ShardLocation = apps.get_model('todo', 'ShardLocation')
+    label = model._meta.label_lower
+    alias = ShardLocation.objects.using(get_directory_db()).filter(model=label, object_id=pk) \
+        .values_list('shard', flat=True).first() or shard_of_id(pk)
+    if alias is not None:
+        return alias
+
+    def exists(alias):
+        if model._base_manager.using(alias).filter(pk=pk).exists():
+            return True
+        return archive_model is not None and archive_model.objects.using(alias).filter(original_id=pk).exists()
+
+    found = [alias for alias, ok in run_on_shards(exists, shards).items() if ok]
+    if not found:
+        return None
+    ShardLocation.objects.using(get_directory_db()).get_or_create(model=label, object_id=pk,
+                                                                  defaults={'shard': found[0]})
+    return found[0]
+
+
+def shard_for_owner(owner_id):
+    # Корневые папки пользователя создаются на закрепленном за ним шарде
+    shards = get_shards()
+    if len(shards) == 1:
+        return shards[0]
+    ShardAssignment = apps.get_model('todo', 'ShardAssignment')
+    assignment, _ = ShardAssignment.objects.using(get_directory_db()).get_or_create(
+        owner_id=owner_id, defaults={'shard': shards[owner_id % len(shards)]},
+    )
+    return assignment.shard
+
+
+def allocate_ids(model, count, using):
+    # count id для новых строк model на шарде using. Номера выдает сам шард, общей блокировки нет:
+    # на PostgreSQL - последовательность таблицы (nextval не ждет другие транзакции),
+    # на остальных базах - счетчик IdSequence на этом же шарде
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                [model._meta.db_table, model._meta.pk.column, count],
+            )
+            numbers = [row[0] for row in cursor.fetchall()]
+    else:
+        IdSequence = apps.get_model('todo', 'IdSequence')
+        with transaction.atomic(using=using):
+            sequence, _ = IdSequence.objects.using(using).select_for_update().get_or_create(
+                name=model._meta.label_lower,
+            )
+            start = sequence.last_value + 1
+            sequence.last_value += count
+            sequence.save(using=using, update_fields=['last_value'])
+        numbers = range(start, start + count)
+    index = get_shards().index(using)
+    return [SHARD_ID_OFFSET + number * SHARD_ID_STRIDE + index for number in numbers]
+
+
+def assign_ids(objs, using=None):
+    # Для bulk_create: save() не вызывается, поэтому id выдаем заранее
+    objs = [obj for obj in objs if obj.pk is None]
+    if not objs or not is_sharded() or objs[0]._meta.model_name not in GLOBAL_ID_MODELS:
+        return
+    using = using or router.db_for_write(type(objs[0]), instance=objs[0])
+    for obj, pk in zip(objs, allocate_ids(type(objs[0]), len(objs), using)):
+        obj.pk = pk
+
+
+def assign_id(sender, instance, raw=False, using=None, **kwargs):
+    if not raw and instance.pk is None and is_sharded():
+        assign_ids([instance], using)
+
+
+def replicate_user(sender, instance, using, raw=False, **kwargs):
+    # Пользователи пишутся в каталог и копируются на остальные шарды
+    if raw or not is_sharded() or using != get_directory_db():
+        return
+    values = {field.attname: getattr(instance, field.attname)
+              for field in instance._meta.concrete_fields if not field.primary_key}
+    for alias in get_shards()[1:]:
+        type(instance)._base_manager.using(alias).update_or_create(pk=instance.pk, defaults=values)
+
+
+def delete_replicated_user(sender, instance, using, **kwargs):
+    if not is_sharded() or using != get_directory_db():
+        return
+    for alias in get_shards()[1:]:
+        type(instance)._base_manager.using(alias).filter(pk=instance.pk).delete()
+
+
+class ShardRouter:
+
+    def _db_for(self, model, hints):
+        instance = hints.get('instance')
+        # Связанный пользователь лежит в каталоге и на всех шардах - шард объекта по нему не определить
+        if instance is not None and instance._state.db and (
+                not is_sharded_model(model) or is_sharded_model(instance._meta.model)):
+            return instance._state.db
+        if model._meta.app_label != 'todo':
+            return None
+        if not is_sharded_model(model):
+            return get_directory_db()
+        return current_shard()
+
+    def db_for_read(self, model, **hints):
+        return self._db_for(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Пользователи есть на каждом шарде, остальные связи - только внутри одной базы
+        if is_sharded_model(obj1._meta.model) and is_sharded_model(obj2._meta.model):
+            return obj1._state.db == obj2._state.db
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db not in get_shards() or db == get_directory_db():
+            return None
+        return app_label == 'todo' or app_label in REPLICATED_APPS
+
+
+class MultiShardQuerySet:
+    # Список объектов, собранный с нескольких шардов: отдает count() и срезы для пагинации DRF.
+    # Каждый шард возвращает упорядоченный префикс, префиксы сливаются с тем же порядком.
+
+    def __init__(self, get_queryset, shards=None):
+        self.get_queryset = get_queryset
+        self.shards = get_shards() if shards is None else shards
+
+    def _ordered(self):
+        queryset = self.get_queryset()
+        ordering = list(queryset.query.order_by) or ['pk']
+        if ordering[-1] not in ('pk', 'id', '-pk', '-id'):
+            # Уникальный последний ключ делает порядок устойчивым
+            ordering.append('-pk' if ordering[-1].startswith('-') else 'pk')
+        return queryset.order_by(*ordering), ordering
+
+    def count(self):
+        return sum(run_on_shards(lambda alias: self.get_queryset().count(), self.shards).values())
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        start, stop = item.start or 0, item.stop
+        _, ordering = self._ordered()
+        descending = ordering[0].startswith('-')
+        names = [name.lstrip('-') for name in ordering]
+
+        def fetch(alias):
+            queryset, _ = self._ordered()
+            return list(queryset if stop is None else queryset[:stop])
+
+        results = run_on_shards(fetch, self.shards).values()
+        merged = heapq.merge(
+            *results,
+            key=lambda obj: tuple(getattr(obj, 'pk' if name == 'pk' else name) for name in names),
+            reverse=descending,
+        )
+        return list(merged)[start:stop]
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def _chunks(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def owner_loads(alias):
+    # Число задач в поддеревьях корневых папок каждого владельца на шарде
+    Task = apps.get_model('todo', 'Task')
+    rows = Task._base_manager.using(alias).filter(
+        page__folder__ancestor_links__ancestor__parent=None,
+    ).values('page__folder__ancestor_links__ancestor__owner').annotate(load=Count('pk'))
+    return {row['page__folder__ancestor_links__ancestor__owner']: row['load'] for row in rows}
+
+
+def owner_shards(owner_id):
+    # Шарды, на которых у владельца есть корневые папки
+    Folder = apps.get_model('todo', 'Folder')
+    found = run_on_shards(
+        lambda alias: Folder._base_manager.using(alias).filter(owner_id=owner_id, parent=None).exists()
+    )
+    return [alias for alias, ok in found.items() if ok]
+
+
+def move_owner(owner_id, source, target, batch_size=1000):
+    # Переносит поддеревья корневых папок владельца с шарда source на target с сохранением id.
+    # Запускать, пока данные владельца не меняются: записи, сделанные во время переноса, не попадут на новый шард.
+    if source == target:
+        return {}
+    Folder, FolderClosure, FolderPermission, Page, PagePermission, Task, TaskPermission = (
+        apps.get_model('todo', name) for name in
+        ('Folder', 'FolderClosure', 'FolderPermission', 'Page', 'PagePermission', 'Task', 'TaskPermission')
+    )
+
+    roots = Folder._base_manager.using(source).filter(owner_id=owner_id, parent=None)
+    folder_ids = list(FolderClosure.objects.using(source).filter(ancestor__in=roots)
+                      .values_list('descendant_id', flat=True).distinct())
+    page_ids = list(Page._base_manager.using(source).filter(folder_id__in=folder_ids).values_list('pk', flat=True)) \
+        if folder_ids else []
+    task_ids = set(Task._base_manager.using(source).filter(page_id__in=page_ids).values_list('pk', flat=True)) \
+        if page_ids else set()
+
+    # Порядок вставки: родители раньше детей; удаление идет в обратном порядке
+    plan = [
+        (Folder, 'pk', folder_ids),
+        (FolderClosure, 'descendant_id', folder_ids),
+        (FolderPermission, 'folder_id', folder_ids),
+        (Page, 'pk', page_ids),
+        (PagePermission, 'page_id', page_ids),
+        (Task, 'pk', task_ids),
+        (TaskPermission, 'task_id', task_ids),
+    ]
+    stats = {}
+    moved = {}
+    reminder_ids = []
+
+    with transaction.atomic(using=target):
+        # Остатки прерванного переноса удаляем, чтобы повторный запуск был безопасен
+        for model, field, ids in reversed(plan):
+            for chunk in _chunks(ids, batch_size):
+                model._base_manager.using(target).filter(**{f'{field}__in': chunk}).delete()
+        for model, field, ids in plan:
+            copied = 0
+            for chunk in _chunks(ids, batch_size):
+                rows = list(model._base_manager.using(source).filter(**{f'{field}__in': chunk}))
+                for row in rows:
+                    if model is FolderClosure:
+                        row.pk = None
+                    elif model is Task:
+                        if row.previous_version_id not in task_ids:
+                            row.previous_version_id = None
+                        if row.remind_at is not None:
+                            reminder_ids.append(row.pk)
+                model._base_manager.using(target).bulk_create(rows, batch_size=batch_size)
+                copied += len(rows)
+                if model._meta.model_name in GLOBAL_ID_MODELS:
+                    moved.setdefault(model._meta.label_lower, []).extend(row.pk for row in rows)
+            stats[model._meta.model_name] = copied
+        # Планировщик target уже прошел окно этих напоминаний - передаем задачи ему через очередь изменений
+        ReminderChange = apps.get_model('todo', 'ReminderChange')
+        ReminderChange.objects.using(target).bulk_create(
+            [ReminderChange(task_id=pk) for pk in reminder_ids], batch_size=batch_size,
+        )
+
+    # id перенесенных объектов больше не указывают на их шард - запоминаем новый шард в каталоге
+    # до удаления с source, чтобы запросы сразу шли на target
+    ShardLocation = apps.get_model('todo', 'ShardLocation')
+    ShardLocation.objects.using(get_directory_db()).bulk_create(
+        [ShardLocation(model=label, object_id=pk, shard=target) for label, pks in moved.items() for pk in pks],
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['model', 'object_id'],
+        update_fields=['shard'],
+    )
+
+    with transaction.atomic(using=source):
+        for model, field, ids in reversed(plan):
+            for chunk in _chunks(ids, batch_size):
+                model._base_manager.using(source).filter(**{f'{field}__in': chunk}).delete()
+
+    ShardAssignment = apps.get_model('todo', 'ShardAssignment')
+    ShardAssignment.objects.using(get_directory_db()).update_or_create(owner_id=owner_id, defaults={'shard': target})
+    return stats
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Узкий UPDATE через VersionedModel.save_changed: sender=модель, instance, fields, using
+fields_updated = Signal()
+
+# Пачка задач, по которым наступило время напоминания: sender=Task, tasks, using
+reminders_due = Signal()
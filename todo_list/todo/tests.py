@@ -1,3 +1,774 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import router
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import copying, retention, sharding
+from .models import (CopyJob, Folder, FolderClosure, FolderPermission, Page, PagePermission, ReminderChange,
+                     ShardAssignment, ShardLocation, Task, TaskArchive, TaskPermission)
+from .ranking import RANK_DIGITS, RANK_MAX_LENGTH, rank_after, rank_between, spread_ranks
+from .reminders import ReminderScheduler
+from .serializers import TaskSerializer, VersionConflict
+from .signals import reminders_due
+
+# Запуск: python manage.py test todo --settings=todo_list.test_settings
+
+
+class RankingTests(SimpleTestCase):
+
+    def assertBetween(self, before, after):
+        rank = rank_between(before, after)
+        self.assertTrue((before or '') < rank, (before, rank, after))
+        if after is not None:
+            self.assertTrue(rank < after, (before, rank, after))
+        self.assertFalse(rank.endswith('0'), rank)
+        self.assertTrue(set(rank) <= set(RANK_DIGITS), rank)
+        return rank
+
+    def test_empty_list_and_ends(self):
+        self.assertEqual(rank_between(None, None), 'i')
+        self.assertBetween(None, 'i')
+        self.assertBetween('i', None)
+        self.assertBetween('z', None)
+        self.assertBetween(None, '1')
+
+    def test_adjacent_keys(self):
+        self.assertBetween('a', 'b')
+        self.assertBetween('a', 'a1')
+        self.assertBetween('az', 'b')
+        self.assertBetween('a', 'a01')
+
+    def test_repeated_inserts_stay_ordered(self):
+        # Вставка все время в одно место: ключи растут, но порядок сохраняется
+        low, high = 'a', 'b'
+        for _ in range(100):
+            high = self.assertBetween(low, high)
+        for _ in range(100):
+            low = self.assertBetween(low, high)
+
+    def test_invalid_bounds(self):
+        with self.assertRaises(ValueError):
+            rank_between('b', 'a')
+        with self.assertRaises(ValueError):
+            rank_between('a', 'a')
+
+    def test_spread_ranks(self):
+        for count in (0, 1, 35, 36, 1000):
+            ranks = spread_ranks(count)
+            self.assertEqual(len(ranks), count)
+            self.assertEqual(ranks, sorted(ranks))
+            self.assertEqual(len(set(ranks)), count)
+            self.assertFalse(any(rank.endswith('0') or not rank for rank in ranks))
+        # Между соседними ключами остается место для вставки
+        ranks = spread_ranks(1000)
+        for before, after in zip(ranks, ranks[1:]):
+            self.assertBetween(before, after)
+
+    def test_rank_after_grows_slowly(self):
+        rank = None
+        for count in range(1, 2001):
+            previous, rank = rank, rank_after(rank)
+            self.assertTrue(previous is None or previous < rank)
+            self.assertFalse(rank.endswith('0'))
+            if previous:
+                # Между соседними добавленными ключами остается место для вставки
+                self.assertBetween(previous, rank)
+        self.assertLessEqual(len(rank), RANK_MAX_LENGTH)
+        self.assertEqual(rank_after('z'), 'z1')
+        self.assertEqual(rank_after('az'), 'b')
+
+
+@override_settings(TODO_SHARDS=['default'])
+class TaskOrderTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('writer', password='pw')
+        cls.folder = Folder.objects.create(name='f', owner=cls.user)
+        cls.page = Page.objects.create(name='p', folder=cls.folder, created_by=cls.user, updated_by=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_task(self, text, **values):
+        return Task.objects.create(text=text, page=self.page, status='IN_PROGRESS', user=self.user,
+                                   created_by=self.user, updated_by=self.user, **values)
+
+    def page_order(self):
+        response = self.client.get(f'/api/v3/tasks/?page={self.page.pk}')
+        texts = [item['text'] for item in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            texts += [item['text'] for item in response.data['results']]
+        return texts
+
+    def move(self, task, **neighbours):
+        return self.client.post(f'/api/v3/tasks/{task.pk}/move/',
+                                {key: value.pk for key, value in neighbours.items()}, format='json')
+
+    def test_append_rebalances_instead_of_overflowing(self):
+        self.create_task('full', rank='z' * RANK_MAX_LENGTH)
+        response = self.client.post('/api/v3/tasks/', {'text': 'next', 'page': self.page.pk,
+                                                       'status': 'IN_PROGRESS', 'user': self.user.pk},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertLessEqual(len(response.data['rank']), RANK_MAX_LENGTH)
+        self.assertEqual(self.page_order(), ['full', 'next'])
+
+    def test_move_between_tasks_without_rank(self):
+        # Задачи, созданные через ORM или админку, остаются с пустым ключом
+        first, second, third = (self.create_task(text) for text in ('a', 'b', 'c'))
+        response = self.move(third, after=first, before=second)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.page_order(), ['a', 'c', 'b'])
+        self.assertEqual(self.move(first, before=third).status_code, 200)
+        self.assertEqual(self.page_order(), ['a', 'c', 'b'])
+
+    def test_move_next_to_equal_ranks(self):
+        # Параллельные добавления получают одинаковый ключ
+        first, second, third = (self.create_task(text, rank='i') for text in ('a', 'b', 'c'))
+        response = self.move(first, after=second)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.page_order(), ['b', 'a', 'c'])
+        response = self.move(third, before=second)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.page_order(), ['c', 'b', 'a'])
+
+    def test_move_with_reversed_neighbours(self):
+        first, second, third = (self.create_task(text, rank=text) for text in ('a', 'b', 'c'))
+        response = self.move(first, after=third, before=second)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.page_order(), ['a', 'b', 'c'])
+
+
+@override_settings(TODO_SHARDS=['default'])
+class VersionConflictTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('editor', password='pw')
+        cls.folder = Folder.objects.create(name='f', owner=cls.user)
+        cls.page = Page.objects.create(name='p', folder=cls.folder, created_by=cls.user, updated_by=cls.user)
+        cls.task = Task.objects.create(text='t', page=cls.page, status='IN_PROGRESS', user=cls.user,
+                                       created_by=cls.user, updated_by=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f'/api/v3/tasks/{self.task.pk}/'
+
+    def test_update_with_current_version(self):
+        response = self.client.patch(self.url, {'text': 'new', 'version': 1}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['version'], 2)
+        self.assertEqual(Task.objects.get(pk=self.task.pk).text, 'new')
+
+    def test_stale_version_in_body(self):
+        Task.objects.filter(pk=self.task.pk).update(version=2)
+        response = self.client.patch(self.url, {'text': 'lost', 'version': 1}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Task.objects.get(pk=self.task.pk).text, 't')
+
+    def test_stale_if_match(self):
+        Task.objects.filter(pk=self.task.pk).update(version=2)
+        response = self.client.patch(self.url, {'text': 'lost'}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 409)
+        response = self.client.patch(self.url, {'text': 'kept'}, format='json', HTTP_IF_MATCH='"2"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid_if_match(self):
+        response = self.client.patch(self.url, {'text': 'x'}, format='json', HTTP_IF_MATCH='"abc"')
+        self.assertEqual(response.status_code, 400)
+
+    def test_concurrent_update_between_read_and_write(self):
+        # Версия совпала при чтении, но строку успели изменить до UPDATE: условие version= не срабатывает
+        stale = Task.objects.get(pk=self.task.pk)
+        Task.objects.filter(pk=self.task.pk).update(text='other', version=2)
+        serializer = TaskSerializer(stale, data={'text': 'lost'}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        with self.assertRaises(VersionConflict):
+            serializer.save()
+        self.assertEqual(Task.objects.get(pk=self.task.pk).text, 'other')
+
+
+@override_settings(TODO_SHARDS=['default'])
+class VisibilityTests(TestCase):
+    # Публичная папка видна всем, но вложенные закрытые страницы и папки - только тем, у кого есть доступ
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='pw')
+        cls.stranger = User.objects.create_user('stranger', password='pw')
+        cls.folder = Folder.objects.create(name='public', owner=cls.owner, is_public=True)
+        cls.open_child = Folder.objects.create(name='open', owner=cls.owner, parent=cls.folder, is_public=True)
+        cls.closed_child = Folder.objects.create(name='closed', owner=cls.owner, parent=cls.folder)
+        cls.open_page = Page.objects.create(name='open-page', folder=cls.folder, is_public=True,
+                                            created_by=cls.owner, updated_by=cls.owner)
+        cls.closed_page = Page.objects.create(name='closed-page', folder=cls.folder,
+                                              created_by=cls.owner, updated_by=cls.owner)
+        cls.open_task, cls.closed_task = (
+            Task.objects.create(text=page.name, page=page, status='IN_PROGRESS', user=cls.owner,
+                                created_by=cls.owner, updated_by=cls.owner)
+            for page in (cls.open_page, cls.closed_page)
+        )
+
+    def get_included(self, user):
+        client = APIClient()
+        if user:
+            client.force_authenticate(user)
+        response = client.get(f'/api/v3/folders/{self.folder.pk}/?include=pages,children')
+        self.assertEqual(response.status_code, 200)
+        return ({item['id'] for item in response.data['pages']},
+                {item['id'] for item in response.data['children']})
+
+    def get_subtree(self, user, name):
+        client = APIClient()
+        if user:
+            client.force_authenticate(user)
+        ids, url = set(), f'/api/v3/folders/{self.folder.pk}/{name}/'
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids |= {item['id'] for item in response.data['results']}
+            url = response.data['next']
+        return ids
+
+    def test_include_hides_private_objects(self):
+        for user in (None, self.stranger):
+            pages, children = self.get_included(user)
+            self.assertEqual(pages, {self.open_page.pk})
+            self.assertEqual(children, {self.open_child.pk})
+
+    def test_include_shows_everything_to_owner(self):
+        pages, children = self.get_included(self.owner)
+        self.assertEqual(pages, {self.open_page.pk, self.closed_page.pk})
+        self.assertEqual(children, {self.open_child.pk, self.closed_child.pk})
+
+    def test_include_follows_shared_folder(self):
+        FolderPermission.objects.create(folder=self.folder, user=self.stranger, can_view=True)
+        pages, children = self.get_included(self.stranger)
+        self.assertEqual(pages, {self.open_page.pk, self.closed_page.pk})
+        self.assertEqual(children, {self.open_child.pk, self.closed_child.pk})
+
+    def test_subtree_actions_hide_private_objects(self):
+        for user in (None, self.stranger):
+            self.assertEqual(self.get_subtree(user, 'pages'), {self.open_page.pk})
+            self.assertEqual(self.get_subtree(user, 'tasks'), {self.open_task.pk})
+        self.assertEqual(self.get_subtree(self.owner, 'pages'), {self.open_page.pk, self.closed_page.pk})
+        self.assertEqual(self.get_subtree(self.owner, 'tasks'), {self.open_task.pk, self.closed_task.pk})
+
+
+@override_settings(TODO_SHARDS=['default'])
+class ReminderTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reminded', password='pw')
+        cls.folder = Folder.objects.create(name='f', owner=cls.user)
+        cls.sub = Folder.objects.create(name='sub', owner=cls.user, parent=cls.folder)
+        cls.page = Page.objects.create(name='p', folder=cls.sub, created_by=cls.user, updated_by=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.now = timezone.now()
+        self.fired = []
+        reminders_due.connect(self.on_due, sender=Task)
+        self.addCleanup(reminders_due.disconnect, self.on_due, sender=Task)
+
+    def on_due(self, sender, tasks, using, **kwargs):
+        self.fired.extend(task.pk for task in tasks)
+
+    def create_task(self, remind_in, status='IN_PROGRESS'):
+        return Task.objects.create(text='t', page=self.page, status=status, user=self.user, created_by=self.user,
+                                   updated_by=self.user, remind_at=self.now + timedelta(seconds=remind_in))
+
+    def run_scheduler(self, scheduler, seconds):
+        with self.captureOnCommitCallbacks(execute=True):
+            return scheduler.run_once(self.now + timedelta(seconds=seconds))
+
+    def test_fires_due_reminders_once(self):
+        overdue, later = self.create_task(-60), self.create_task(30)
+        scheduler = ReminderScheduler(now=self.now)
+        self.assertEqual(self.run_scheduler(scheduler, 0), 1)
+        self.assertEqual(self.run_scheduler(scheduler, 31), 1)
+        self.assertEqual(self.run_scheduler(scheduler, 60), 0)
+        self.assertEqual(self.fired, [overdue.pk, later.pk])
+        self.assertIsNotNone(Task.objects.get(pk=later.pk).reminded_at)
+
+    def test_api_changes_reach_loaded_scheduler(self):
+        task = self.create_task(30)
+        scheduler = ReminderScheduler(now=self.now)
+        self.run_scheduler(scheduler, 0)
+        url = f'/api/v3/tasks/{task.pk}/'
+        remind_at = (self.now + timedelta(seconds=90)).isoformat()
+        self.assertEqual(self.client.patch(url, {'remind_at': remind_at}, format='json').status_code, 200)
+        self.assertEqual(self.run_scheduler(scheduler, 31), 0)
+        self.assertEqual(self.run_scheduler(scheduler, 91), 1)
+        self.assertEqual(self.fired, [task.pk])
+
+    def test_closed_tasks_are_not_loaded(self):
+        task = self.create_task(-60, status='DONE')
+        self.assertFalse(Task.pending_reminders().filter(pk=task.pk).exists())
+        scheduler = ReminderScheduler(now=self.now)
+        self.assertEqual(self.run_scheduler(scheduler, 0), 0)
+        self.assertNotIn(task.pk, scheduler.wheel)
+        # Задача возвращена в работу - напоминание снова в очереди
+        response = self.client.patch(f'/api/v3/tasks/{task.pk}/', {'status': 'IN_PROGRESS'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.run_scheduler(scheduler, 1), 1)
+        self.assertEqual(self.fired, [task.pk])
+
+    def test_restored_subtree_is_rescheduled(self):
+        task = self.create_task(30)
+        self.assertEqual(self.client.delete(f'/api/v3/folders/{self.folder.pk}/').status_code, 204)
+        scheduler = ReminderScheduler(now=self.now)
+        self.run_scheduler(scheduler, 0)
+        self.assertNotIn(task.pk, scheduler.wheel)
+        ReminderChange.objects.all().delete()
+
+        response = self.client.post(f'/api/v3/folders/{self.folder.pk}/restore/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Task.objects.get(pk=task.pk).is_deleted)
+        self.assertEqual(self.run_scheduler(scheduler, 31), 1)
+        self.assertEqual(self.fired, [task.pk])
+
+
+@override_settings(TODO_SHARDS=['default'])
+class RetentionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('archivist', password='pw')
+        cls.folder = Folder.objects.create(name='f', owner=cls.user)
+        cls.page = Page.objects.create(name='p', folder=cls.folder, created_by=cls.user, updated_by=cls.user)
+
+    def create_task(self, **kwargs):
+        return Task.objects.create(text='t', page=self.page, status='IN_PROGRESS', user=self.user,
+                                   created_by=self.user, updated_by=self.user, **kwargs)
+
+    def test_archive_batch_rechecks_rows_under_lock(self):
+        # Между выбором id и блокировкой на удаленную версию сослалась новая задача: ее нельзя
+        # архивировать, иначе delete() каскадом удалит и новую задачу
+        cutoff = timezone.now()
+        old = self.create_task(is_deleted=True, deleted_at=cutoff - timedelta(days=1))
+        new = self.create_task(previous_version=old)
+        stale = Task.objects.filter(pk=old.pk)
+        with mock.patch.object(retention, 'archivable', side_effect=[stale, retention.archivable(Task, cutoff)]):
+            self.assertEqual(retention.archive_batch(Task, cutoff, 10), 0)
+        self.assertTrue(Task.objects.filter(pk=new.pk).exists())
+        self.assertTrue(Task.objects.filter(pk=old.pk, is_deleted=True).exists())
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def archive(self):
+        return retention.run_retention(archive_after_days=0)
+
+    def test_archive_and_restore_task(self):
+        reader = User.objects.create_user('reader', password='pw')
+        task = self.create_task()
+        TaskPermission.objects.create(task=task, user=reader, can_view=True)
+        self.assertEqual(self.client.delete(f'/api/v3/tasks/{task.pk}/').status_code, 204)
+        self.assertEqual(self.archive()['task']['archived'], 1)
+        self.assertFalse(Task.objects.filter(pk=task.pk).exists())
+        self.assertEqual(self.client.get(f'/api/v3/tasks/{task.pk}/').status_code, 404)
+
+        response = self.client.post(f'/api/v3/tasks/{task.pk}/restore/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], task.pk)
+        restored = Task.objects.get(pk=task.pk)
+        self.assertEqual(restored.page_id, self.page.pk)
+        # Время создания - исходное (JSON архива хранит его с точностью до миллисекунд)
+        self.assertLess(abs(restored.created_at - task.created_at), timedelta(milliseconds=1))
+        self.assertTrue(TaskPermission.objects.filter(task=task, user=reader, can_view=True).exists())
+        self.assertFalse(TaskArchive.objects.filter(original_id=task.pk).exists())
+        self.assertEqual(self.client.post(f'/api/v3/tasks/{task.pk}/restore/').status_code, 404)
+
+    def test_restore_requires_parent(self):
+        task = self.create_task()
+        self.assertEqual(self.client.delete(f'/api/v3/folders/{self.folder.pk}/').status_code, 204)
+        self.archive()
+        self.assertEqual(self.client.post(f'/api/v3/tasks/{task.pk}/restore/').status_code, 400)
+        self.assertTrue(TaskArchive.objects.filter(original_id=task.pk).exists())
+
+    def test_restore_folder_brings_back_subtree(self):
+        sub = Folder.objects.create(name='sub', owner=self.user, parent=self.folder)
+        page = Page.objects.create(name='sub-page', folder=sub, created_by=self.user, updated_by=self.user)
+        task = Task.objects.create(text='t', page=page, status='IN_PROGRESS', user=self.user,
+                                   created_by=self.user, updated_by=self.user)
+        # Удаленное раньше и по отдельности остается удаленным
+        earlier = self.create_task()
+        self.assertEqual(self.client.delete(f'/api/v3/tasks/{earlier.pk}/').status_code, 204)
+        self.assertEqual(self.client.delete(f'/api/v3/folders/{self.folder.pk}/').status_code, 204)
+
+        # Мягко удаленное поддерево
+        self.assertEqual(self.client.post(f'/api/v3/folders/{self.folder.pk}/restore/').status_code, 200)
+        self.assertEqual(set(Folder.objects.filter(is_deleted=False).values_list('pk', flat=True)),
+                         {self.folder.pk, sub.pk})
+        self.assertEqual(Page.objects.filter(pk__in=[self.page.pk, page.pk], is_deleted=False).count(), 2)
+        self.assertFalse(Task.objects.get(pk=task.pk).is_deleted)
+        self.assertTrue(Task.objects.get(pk=earlier.pk).is_deleted)
+
+        # Поддерево из архива
+        self.assertEqual(self.client.delete(f'/api/v3/folders/{self.folder.pk}/').status_code, 204)
+        stats = self.archive()
+        self.assertEqual((stats['folder']['archived'], stats['page']['archived'], stats['task']['archived']),
+                         (2, 2, 2))
+        response = self.client.post(f'/api/v3/folders/{self.folder.pk}/restore/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Folder.objects.get(pk=sub.pk).parent_id, self.folder.pk)
+        self.assertEqual(set(FolderClosure.objects.filter(ancestor=self.folder).values_list('descendant_id', flat=True)),
+                         {self.folder.pk, sub.pk})
+        self.assertEqual(Task.objects.get(pk=task.pk).page_id, page.pk)
+        self.assertTrue(Page.objects.filter(pk=self.page.pk).exists())
+        self.assertFalse(Task.objects.filter(pk=earlier.pk).exists())
+        self.assertTrue(TaskArchive.objects.filter(original_id=earlier.pk).exists())
+
+
+@override_settings(TODO_SHARDS=['default'])
+class CopyTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('copier', password='pw')
+        cls.reader = User.objects.create_user('reader', password='pw')
+        cls.folder = Folder.objects.create(name='src', owner=cls.owner)
+        cls.sub = Folder.objects.create(name='src-sub', owner=cls.owner, parent=cls.folder)
+        cls.target = Folder.objects.create(name='target', owner=cls.owner)
+        cls.page = Page.objects.create(name='src-page', folder=cls.sub, created_by=cls.owner, updated_by=cls.owner)
+        cls.tasks = [
+            Task.objects.create(text=text, page=cls.page, status='IN_PROGRESS', user=cls.owner, is_deleted=deleted,
+                                created_by=cls.owner, updated_by=cls.owner)
+            for text, deleted in (('a', False), ('b', False), ('gone', True))
+        ]
+        FolderPermission.objects.create(folder=cls.sub, user=cls.reader, can_view=True)
+        PagePermission.objects.create(page=cls.page, user=cls.reader, can_view=True)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def copied_subtree(self, folder_id):
+        folder = Folder.objects.get(pk=folder_id)
+        sub = Folder.objects.get(parent=folder)
+        page = Page.objects.get(folder=sub)
+        return folder, sub, page, sorted(Task.objects.filter(page=page).values_list('text', flat=True))
+
+    def test_copy_folder(self):
+        response = self.client.post(f'/api/v3/folders/{self.folder.pk}/copy/', {}, format='json')
+        self.assertEqual(response.status_code, 201)
+        folder, sub, page, texts = self.copied_subtree(response.data['id'])
+        self.assertEqual((folder.name, folder.parent_id, sub.name), ('src (копия)', None, 'src-sub (копия)'))
+        self.assertEqual(texts, ['a', 'b'])
+        self.assertNotEqual(page.pk, self.page.pk)
+        self.assertEqual(set(FolderClosure.objects.filter(ancestor=folder).values_list('descendant_id', flat=True)),
+                         {folder.pk, sub.pk})
+        # Права без permissions=true не копируются
+        self.assertFalse(FolderPermission.objects.filter(folder=sub).exists())
+
+        response = self.client.post(f'/api/v3/folders/{self.folder.pk}/copy/',
+                                    {'parent': self.target.pk, 'name': 'with-grants', 'permissions': True},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        folder, sub, page, _ = self.copied_subtree(response.data['id'])
+        self.assertEqual((folder.name, folder.parent_id), ('with-grants', self.target.pk))
+        self.assertTrue(FolderPermission.objects.filter(folder=sub, user=self.reader, can_view=True).exists())
+        self.assertTrue(PagePermission.objects.filter(page=page, user=self.reader, can_view=True).exists())
+
+    def test_copy_page(self):
+        response = self.client.post(f'/api/v3/pages/{self.page.pk}/copy/', {'folder': self.target.pk}, format='json')
+        self.assertEqual(response.status_code, 201)
+        page = Page.objects.get(pk=response.data['id'])
+        self.assertEqual((page.name, page.folder_id), ('src-page (копия)', self.target.pk))
+        self.assertEqual(sorted(Task.objects.filter(page=page).values_list('text', flat=True)), ['a', 'b'])
+
+        response = self.client.post(f'/api/v3/pages/{self.page.pk}/copy/', {'folder': None}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(f'/api/v3/pages/{self.page.pk}/copy/', {'name': 'src-page'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_only_owner_copies_permissions(self):
+        FolderPermission.objects.create(folder=self.folder, user=self.reader, can_view=True)
+        self.client.force_authenticate(self.reader)
+        url = f'/api/v3/folders/{self.folder.pk}/copy/'
+        response = self.client.post(url, {'parent': None, 'permissions': True}, format='json')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(url, {'parent': None}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Folder.objects.get(pk=response.data['id']).owner_id, self.reader.pk)
+
+    @override_settings(TODO_COPY={'SYNC_LIMIT': 1})
+    def test_large_copy_runs_as_job(self):
+        response = self.client.post(f'/api/v3/folders/{self.folder.pk}/copy/', {'parent': self.target.pk},
+                                    format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'PENDING')
+        job_url = f"/api/v3/copyjobs/{response.data['id']}/"
+        self.assertEqual(self.client.get(job_url).data['status'], 'PENDING')
+        self.assertFalse(Folder.objects.filter(parent=self.target).exists())
+
+        self.assertEqual(copying.run_pending_jobs(), 1)
+        self.assertEqual(copying.run_pending_jobs(), 0)
+        response = self.client.get(job_url)
+        self.assertEqual(response.data['status'], 'DONE')
+        folder, _, _, texts = self.copied_subtree(response.data['result_id'])
+        self.assertEqual((folder.parent_id, texts), (self.target.pk, ['a', 'b']))
+
+        # Другой пользователь чужое задание не видит
+        self.client.force_authenticate(self.reader)
+        self.assertEqual(self.client.get(job_url).status_code, 404)
+
+    def test_job_fails_when_source_is_deleted(self):
+        job = CopyJob.objects.create(kind='page', source_id=self.page.pk, target_id=self.target.pk, user=self.owner)
+        Page.objects.filter(pk=self.page.pk).update(is_deleted=True)
+        self.assertEqual(copying.run_pending_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result_id), ('FAILED', None))
+        self.assertTrue(job.error)
+
+
+@override_settings(TODO_SHARDS=['default'])
+class PermissionBatchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('granter', password='pw')
+        cls.reader = User.objects.create_user('reader', password='pw')
+        cls.editor = User.objects.create_user('editor', password='pw')
+        cls.folder = Folder.objects.create(name='f', owner=cls.owner)
+        cls.page = Page.objects.create(name='p', folder=cls.folder, created_by=cls.owner, updated_by=cls.owner)
+        cls.task = Task.objects.create(text='t', page=cls.page, status='IN_PROGRESS', user=cls.owner,
+                                       created_by=cls.owner, updated_by=cls.owner)
+        FolderPermission.objects.create(folder=cls.folder, user=cls.editor, can_view=True, can_edit=True)
+
+    def post(self, user, data):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post('/api/v3/permbatch/', data, format='json')
+
+    def flags(self, model, **lookup):
+        return model.objects.filter(**lookup).values_list('can_view', 'can_edit', 'can_delete').get()
+
+    def test_grant_upserts(self):
+        response = self.post(self.owner, {'grant': [
+            {'folder': self.folder.pk, 'user': self.reader.pk, 'can_view': True},
+            {'page': self.page.pk, 'user': self.reader.pk, 'can_view': True},
+            {'task': self.task.pk, 'user': self.reader.pk, 'can_view': True},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'granted': {'folder': 1, 'page': 1, 'task': 1}, 'revoked': {}})
+
+        # Повторная выдача обновляет флаги существующей строки; из повторов пары побеждает последний
+        response = self.post(self.owner, {'grant': [
+            {'folder': self.folder.pk, 'user': self.reader.pk, 'can_view': True},
+            {'folder': self.folder.pk, 'user': self.reader.pk, 'can_view': True, 'can_edit': True},
+            {'folder': self.folder.pk, 'user': self.editor.pk, 'can_view': True, 'can_delete': True},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['granted'], {'folder': 2})
+        self.assertEqual(self.flags(FolderPermission, folder=self.folder, user=self.reader), (True, True, False))
+        self.assertEqual(self.flags(FolderPermission, folder=self.folder, user=self.editor), (True, False, True))
+        self.assertEqual(FolderPermission.objects.filter(folder=self.folder).count(), 2)
+
+    def test_revoke(self):
+        PagePermission.objects.create(page=self.page, user=self.reader, can_view=True)
+        TaskPermission.objects.create(task=self.task, user=self.reader, can_view=True)
+        response = self.post(self.owner, {
+            'revoke': [{'page': self.page.pk, 'user': self.reader.pk}, {'task': self.task.pk, 'user': self.reader.pk}],
+            # Отзыв выполняется раньше выдачи: пара из обоих списков остается с новыми флагами
+            'grant': [{'task': self.task.pk, 'user': self.reader.pk, 'can_edit': True}],
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'granted': {'task': 1}, 'revoked': {'page': 1, 'task': 1}})
+        self.assertFalse(PagePermission.objects.filter(page=self.page).exists())
+        self.assertEqual(self.flags(TaskPermission, task=self.task, user=self.reader), (False, True, False))
+
+    def test_access_is_checked_before_any_change(self):
+        # Пользователь с правами на папку назначает права страниц и задач, но не самой папки
+        response = self.post(self.editor, {'grant': [{'page': self.page.pk, 'user': self.reader.pk, 'can_view': True}]})
+        self.assertEqual(response.status_code, 200)
+        response = self.post(self.editor, {'grant': [
+            {'task': self.task.pk, 'user': self.reader.pk, 'can_view': True},
+            {'folder': self.folder.pk, 'user': self.reader.pk, 'can_view': True},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('folder', response.data)
+        self.assertFalse(TaskPermission.objects.exists())
+
+        response = self.post(self.reader, {'revoke': [{'page': self.page.pk, 'user': self.reader.pk}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(PagePermission.objects.filter(page=self.page, user=self.reader).exists())
+
+    def test_invalid_batches(self):
+        for data in (
+            {},
+            {'grant': [{'folder': self.folder.pk, 'page': self.page.pk, 'user': self.reader.pk}]},
+            {'grant': [{'folder': self.folder.pk + 1000, 'user': self.reader.pk, 'can_view': True}]},
+            {'revoke': [{'task': self.task.pk, 'user': self.reader.pk + 1000}]},
+        ):
+            self.assertEqual(self.post(self.owner, data).status_code, 400, data)
+        Task.objects.filter(pk=self.task.pk).update(is_deleted=True)
+        response = self.post(self.owner, {'grant': [{'task': self.task.pk, 'user': self.reader.pk}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('task', response.data)
+
+
+class ShardingTests(TransactionTestCase):
+    # run_on_shards читает шарды из потоков, поэтому данные должны быть закоммичены: TransactionTestCase
+    databases = {'default', 's1', 's2'}
+
+    def setUp(self):
+        # Три подряд идущих id владельцев распределяются по трем шардам (owner_id % 3)
+        self.owners = [User.objects.create_user(f'owner{i}', password='pw') for i in range(3)]
+        self.client = APIClient()
+
+    def create_tree(self, owner, name):
+        alias = sharding.shard_for_owner(owner.pk)
+        with sharding.use_shard(alias):
+            folder = Folder.objects.create(name=name, owner=owner)
+            sub = Folder.objects.create(name=f'{name}-sub', owner=owner, parent=folder)
+            page = Page.objects.create(name=f'{name}-page', folder=sub, created_by=owner, updated_by=owner)
+            task = Task.objects.create(text='t', page=page, status='IN_PROGRESS', user=owner,
+                                       created_by=owner, updated_by=owner)
+        return folder, sub, page, task
+
+    def test_router_placement(self):
+        with sharding.use_shard('s2'):
+            self.assertEqual(router.db_for_write(Folder), 's2')
+            # Связанный пользователь из каталога не переносит новую папку в каталог
+            self.assertEqual(router.db_for_write(Folder, instance=self.owners[0]), 's2')
+            self.assertEqual(Folder(name='x', owner=self.owners[0])._state.db, 's2')
+            self.assertEqual(router.db_for_write(ShardAssignment), 'default')
+        self.assertTrue(router.allow_migrate('s1', 'todo'))
+        self.assertTrue(router.allow_migrate('s1', 'auth'))
+        self.assertFalse(router.allow_migrate('s1', 'sessions'))
+        self.assertTrue(router.allow_migrate('default', 'sessions'))
+
+    def test_api_creates_subtree_on_owner_shard(self):
+        owner = self.owners[1]
+        alias = sharding.shard_for_owner(owner.pk)
+        self.client.force_authenticate(owner)
+        response = self.client.post('/api/v3/folders/', {'name': 'root'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        root_id = response.data['id']
+        response = self.client.post('/api/v3/folders/', {'name': 'child', 'parent': root_id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        child_id = response.data['id']
+        response = self.client.post('/api/v3/pages/', {'name': 'page', 'folder': child_id}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(sharding.locate_shard(Folder, root_id), alias)
+        self.assertEqual(sharding.locate_shard(Folder, child_id), alias)
+        self.assertEqual(sharding.locate_shard(Page, response.data['id']), alias)
+        self.assertEqual(FolderClosure.objects.using(alias).filter(ancestor_id=root_id).count(), 2)
+        self.assertEqual(self.client.get(f'/api/v3/folders/{child_id}/').status_code, 200)
+
+    def test_global_ids_are_unique_between_shards(self):
+        ids = [self.create_tree(owner, f'f{i}')[0].pk for i, owner in enumerate(self.owners)]
+        self.assertEqual(len(set(ids)), 3)
+        # Шард новых объектов читается из id, без опроса шардов
+        with mock.patch.object(sharding, 'run_on_shards', side_effect=AssertionError):
+            self.assertEqual({sharding.locate_shard(Folder, pk) for pk in ids}, {'default', 's1', 's2'})
+
+    def test_legacy_id_is_located_once(self):
+        # id, выданный до шардирования, ищется опросом шардов, после чего шард берется из каталога
+        owner = self.owners[2]
+        with sharding.use_shard('s1'):
+            folder = Folder.objects.create(pk=7, name='legacy', owner=owner)
+        self.assertEqual(sharding.locate_shard(Folder, folder.pk), 's1')
+        self.assertEqual(ShardLocation.objects.get(model='todo.folder', object_id=folder.pk).shard, 's1')
+        with mock.patch.object(sharding, 'run_on_shards', side_effect=AssertionError):
+            self.assertEqual(sharding.locate_shard(Folder, folder.pk), 's1')
+        self.assertIsNone(sharding.locate_shard(Folder, 8))
+
+    def test_multi_shard_queryset_merges_in_order(self):
+        names = ['b', 'e', 'h', 'a', 'd', 'g', 'c', 'f', 'i']
+        for index, name in enumerate(names):
+            owner = self.owners[index // 3]
+            with sharding.use_shard(sharding.shard_for_owner(owner.pk)):
+                Folder.objects.create(name=name, owner=owner)
+
+        queryset = sharding.MultiShardQuerySet(lambda: Folder.objects.order_by('name'))
+        self.assertEqual(queryset.count(), 9)
+        self.assertEqual([folder.name for folder in queryset], sorted(names))
+        self.assertEqual([folder.name for folder in queryset[2:5]], ['c', 'd', 'e'])
+        descending = sharding.MultiShardQuerySet(lambda: Folder.objects.order_by('-name'))
+        self.assertEqual([folder.name for folder in descending[:3]], ['i', 'h', 'g'])
+
+    def test_list_paginates_across_shards(self):
+        trees = [self.create_tree(owner, f'f{i}') for i, owner in enumerate(self.owners)]
+        for folder, *_ in trees[1:]:
+            FolderPermission.objects.using(folder._state.db).create(folder=folder, user=self.owners[0],
+                                                                    can_view=True)
+        self.client.force_authenticate(self.owners[0])
+        seen = []
+        url = '/api/v3/folders/'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['count'], 6)
+            seen.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        expected = sorted(pk for folder, sub, *_ in trees for pk in (folder.pk, sub.pk))
+        self.assertEqual(seen, expected)
+
+    def test_move_owner(self):
+        owner = self.owners[1]
+        source = sharding.shard_for_owner(owner.pk)
+        target = next(alias for alias in sharding.get_shards() if alias != source)
+        folder, sub, page, task = self.create_tree(owner, 'moved')
+        TaskPermission.objects.using(source).create(task=task, user=self.owners[0], can_view=True)
+        Task.objects.using(source).filter(pk=task.pk).update(remind_at=timezone.now() + timedelta(hours=1))
+
+        stats = sharding.move_owner(owner.pk, source, target)
+
+        self.assertEqual(stats['folder'], 2)
+        self.assertEqual(stats['task'], 1)
+        self.assertEqual(stats['taskpermission'], 1)
+        self.assertFalse(Folder._base_manager.using(source).filter(owner=owner).exists())
+        self.assertFalse(Task._base_manager.using(source).filter(pk=task.pk).exists())
+        self.assertEqual(set(Folder.objects.using(target).filter(owner=owner).values_list('pk', flat=True)),
+                         {folder.pk, sub.pk})
+        self.assertEqual(Task.objects.using(target).get(pk=task.pk).page_id, page.pk)
+        self.assertEqual(FolderClosure.objects.using(target).filter(ancestor=folder).count(), 2)
+        # Планировщик target узнает о напоминании перенесенной задачи из очереди изменений
+        self.assertTrue(ReminderChange.objects.using(target).filter(task_id=task.pk).exists())
+        self.assertEqual(sharding.shard_for_owner(owner.pk), target)
+        self.assertEqual(sharding.owner_shards(owner.pk), [target])
+        # id перенесенных объектов указывают на старый шард - их шард берется из каталога
+        for model, pk in ((Folder, sub.pk), (Page, page.pk), (Task, task.pk)):
+            self.assertEqual(sharding.locate_shard(model, pk), target)
+        self.client.force_authenticate(owner)
+        self.assertEqual(self.client.get(f'/api/v3/tasks/{task.pk}/').status_code, 200)
+
+        # Новые корневые папки владельца создаются уже на новом шарде
+        response = self.client.post('/api/v3/folders/', {'name': 'after-move'}, format='json')
+        self.assertEqual(sharding.locate_shard(Folder, response.data['id']), target)
+
+    def test_users_are_replicated_to_every_shard(self):
+        user = User.objects.create_user('replica', password='pw')
+        for alias in sharding.get_shards():
+            self.assertEqual(User.objects.using(alias).get(pk=user.pk).username, 'replica')
+
+        user.first_name = 'Новое'
+        user.save()
+        for alias in sharding.get_shards():
+            self.assertEqual(User.objects.using(alias).get(pk=user.pk).first_name, 'Новое')
+
+    def test_user_deletion_removes_copies_and_data(self):
+        owner = self.owners[2]
+        alias = sharding.shard_for_owner(owner.pk)
+        folder, *_ = self.create_tree(owner, 'gone')
+
+        User.objects.get(pk=owner.pk).delete()
+
+        for shard in sharding.get_shards():
+            self.assertFalse(User.objects.using(shard).filter(pk=owner.pk).exists())
+        self.assertFalse(Folder._base_manager.using(alias).filter(pk=folder.pk).exists())
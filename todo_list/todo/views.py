@@ -1,27 +1,227 @@
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Prefetch, Q
+from django.http import Http404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import viewsets, permissions, status
+from rest_framework.decorators import action
+from . import copying, grants, retention, sharding
+from .ranking import RANK_MAX_LENGTH, rank_between
 from .serializers import *
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import NotAuthenticated, PermissionDenied
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 
 
+class ShardedViewSetMixin:
+    # Запрос работает с одним шардом: шард объекта по id, шард родителя создаваемого объекта
+    # (поле shard_parent_field) или шард владельца. Списки без шарда собираются со всех шардов.
+    shard_parent_field = None
+    shard_archive_model = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.shard = self.get_request_shard()
+        self._shard_token = sharding.activate(self.shard)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_shard_token', None)
+        if token is not None:
+            sharding.deactivate(token)
+            self._shard_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def get_request_shard(self):
+        shards = sharding.get_shards()
+        if len(shards) == 1:
+            return shards[0]
+        pk = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        if pk is not None:
+            if not str(pk).isdigit():
+                raise Http404
+            archive_model = self.shard_archive_model if self.action == 'restore' else None
+            return sharding.locate_shard(self.queryset.model, pk, archive_model)
+        if self.action == 'create':
+            return self.get_create_shard()
+        return None
+
+    def get_create_shard(self):
+        parent_id = self.request.data.get(self.shard_parent_field) if self.shard_parent_field else None
+        if parent_id is not None:
+            if not str(parent_id).isdigit():
+                raise serializers.ValidationError({self.shard_parent_field: "Некорректный ID"})
+            parent_model = self.queryset.model._meta.get_field(self.shard_parent_field).related_model
+            return sharding.locate_shard(parent_model, parent_id)
+        return sharding.shard_for_owner(self.request.user.pk)
+
+    def list(self, request, *args, **kwargs):
+        if self.shard is not None:
+            return super().list(request, *args, **kwargs)
+        # Каждый шард отдает упорядоченный префикс, пагинация режет слитый список
+        queryset = sharding.MultiShardQuerySet(lambda: self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(list(queryset), many=True)
+        return Response(serializer.data)
+
+
 class SoftDeletableViewSetMixin:
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         instance.is_deleted = True
-        instance.save()
+        instance.deleted_at = timezone.now()
+        instance.save(update_fields=['is_deleted', 'deleted_at'])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=True, methods=['post'])
+    def restore(self, request, pk=None):
+        # Ищет запись среди мягко удаленных, а затем в архиве
+        if not str(pk).isdigit():
+            raise Http404
+        instance = retention.restore(self.queryset.model, pk, self.check_restore_permission)
+        return Response(self.get_serializer(instance).data)
+
+    def check_restore_permission(self, instance):
+        raise PermissionDenied("У вас нет прав на восстановление этой записи.")
+
     def get_queryset(self):
         return super().get_queryset().filter(is_deleted=False)
 
 
-class FolderViewSet(SoftDeletableViewSetMixin, viewsets.ModelViewSet):
+class CopyViewSetMixin:
+    # Ответ на copy: 201 с копией или 202 с заданием, если поддерево копируется в фоне
+
+    def get_copy_options(self):
+        name = self.request.data.get('name')
+        max_length = self.queryset.model._meta.get_field('name').max_length
+        if name is not None and (not isinstance(name, str) or not name.strip() or len(name) > max_length):
+            raise serializers.ValidationError({"name": f"Ожидается непустая строка до {max_length} символов"})
+        with_permissions = self.request.data.get('permissions', False)
+        if not isinstance(with_permissions, bool):
+            raise serializers.ValidationError({"permissions": "Ожидается true или false"})
+        return name, with_permissions
+
+    def get_copy_target(self, key, default):
+        if key not in self.request.data:
+            target = default
+        elif self.request.data[key] is None:
+            target = None
+        else:
+            # Копия создается на шарде исходного объекта, поэтому папка назначения ищется там же
+            try:
+                target = Folder.objects.get(pk=self.request.data[key], is_deleted=False)
+            except (Folder.DoesNotExist, ValueError, TypeError):
+                raise serializers.ValidationError({key: "Папка не найдена"})
+        if target is not None and not target.user_has_access(self.request.user):
+            raise PermissionDenied("У вас нет прав на эту папку.")
+        return target
+
+    def copy_response(self, kind, source, target):
+        name, with_permissions = self.get_copy_options()
+        # Права чужих пользователей переносит только владелец: иначе копия раскрыла бы список выданных прав
+        owner_id = source.owner_id if kind == 'folder' else (source.folder.owner_id if source.folder else None)
+        if with_permissions and owner_id != self.request.user.pk:
+            raise PermissionDenied("Копировать права доступа может только владелец.")
+        if name is not None and type(source).objects.filter(name=name).exists():
+            raise serializers.ValidationError({"name": "Это имя уже занято"})
+        copy, job = copying.start_copy(kind, source, target, self.request.user, name=name,
+                                       with_permissions=with_permissions)
+        if job is not None:
+            return Response(CopyJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+        return Response(self.get_serializer(copy).data, status=status.HTTP_201_CREATED)
+
+
+class IncludeViewSetMixin:
+    # Связанные коллекции, которые можно встроить в list/retrieve через ?include=a,b.
+    # Для каждого имени вьюсет определяет метод include_<name>(queryset, limit)
+    include_options = ()
+    include_limit = 50
+    max_include_limit = 200
+
+    def get_include(self):
+        raw = self.request.query_params.get('include', '')
+        include = {name.strip() for name in raw.split(',') if name.strip()}
+        unknown = include - set(self.include_options)
+        if unknown:
+            raise serializers.ValidationError({"include": f"Неизвестные значения: {', '.join(sorted(unknown))}"})
+        return include
+
+    def get_include_limit(self):
+        raw = self.request.query_params.get('include_limit')
+        if raw is None:
+            return self.include_limit
+        if not raw.isdigit() or int(raw) < 1:
+            raise serializers.ValidationError({"include_limit": "Ожидается положительное число"})
+        return min(int(raw), self.max_include_limit)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['include_limit'] = self.get_include_limit()
+        return context
+
+    def apply_include(self, queryset):
+        # Коллекции подгружаются для уже отфильтрованных по видимости объектов, без повторных проверок
+        if self.action not in ('list', 'retrieve'):
+            return queryset
+        limit = self.get_include_limit()
+        for name in self.get_include():
+            queryset = getattr(self, f'include_{name}')(queryset, limit)
+        return queryset
+
+
+# Правила видимости папок, страниц и задач. Ими же фильтруются встроенные коллекции (?include=)
+# и выборки по поддереву: публичная папка не открывает вложенные в нее закрытые объекты
+
+
+def visible_folders(user):
+    if user.is_authenticated:
+        # Фильтруем только если пользователь авторизован
+        # Права папки наследуются всеми вложенными папками
+        return Folder.objects.filter(
+            Q(id__in=FolderClosure.accessible_folder_ids(user)) | Q(is_public=True)
+        ).filter(is_deleted=False)
+    else:
+        # Для неавторизованных пользователей возвращаем только публичные папки
+        return Folder.objects.filter(is_public=True, is_deleted=False)
+
+
+def visible_pages(user):
+    if user.has_perm('todo.view_page'):
+        return Page.objects.all().filter(is_deleted=False)
+
+    if user.is_authenticated:
+        return Page.objects.filter(
+            Q(folder__in=FolderClosure.accessible_folder_ids(user)) |
+            Q(is_public=True)
+        ).filter(is_deleted=False)
+    else:
+        return Page.objects.filter(is_public=True, is_deleted=False)
+
+
+def visible_tasks(user):
+    if user.has_perm('todo.view_task'):
+        return Task.objects.all().filter(is_deleted=False)
+
+    if user.is_authenticated:
+        return Task.objects.filter(
+            Q(page__folder__in=FolderClosure.accessible_folder_ids(user)) |
+            Q(page__is_public=True)
+        ).filter(is_deleted=False)
+    else:
+        return Task.objects.filter(page__is_public=True, is_deleted=False, page__is_deleted=False)
+
+
+class FolderViewSet(ShardedViewSetMixin, SoftDeletableViewSetMixin, CopyViewSetMixin, IncludeViewSetMixin,
+                    viewsets.ModelViewSet):
     queryset = Folder.objects.all()
     serializer_class = FolderSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    shard_parent_field = 'parent'
+    shard_archive_model = FolderArchive
+    include_options = ('pages', 'children', 'permissions')
 
     def get_object(self):
         queryset = self.get_queryset()
@@ -31,72 +231,162 @@ class FolderViewSet(SoftDeletableViewSetMixin, viewsets.ModelViewSet):
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
-        # Помечаем папку как удаленную
-        instance.is_deleted = True
-        instance.save()
+        subtree = instance.subtree_ids()
+        deleted_at = timezone.now()
+        with transaction.atomic(using=instance._state.db):
+            # Помечаем папку и все вложенные папки как удаленные
+            Folder.objects.filter(id__in=subtree, is_deleted=False).update(is_deleted=True, deleted_at=deleted_at)
 
-        # "Мягко" удаляем страницы в папке
-        for page in instance.page_set.all():
-            page.is_deleted = True
-            page.save()
+            # "Мягко" удаляем страницы в поддереве
+            Page.objects.filter(folder__in=subtree, is_deleted=False).update(is_deleted=True, deleted_at=deleted_at)
 
-        # "Мягко" удаляем задачи в папке
-        for task in Task.objects.filter(page__in=instance.page_set.all()).filter(is_deleted=False):
-            task.is_deleted = True
-            task.save()
+            # "Мягко" удаляем задачи в поддереве
+            Task.objects.filter(page__folder__in=subtree, is_deleted=False).update(is_deleted=True,
+                                                                                  deleted_at=deleted_at)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=True)
+    def pages(self, request, pk=None):
+        folder = self.get_object()
+        # Видимость папки не распространяется на закрытые страницы внутри нее
+        queryset = visible_pages(request.user).using(folder._state.db) \
+            .filter(folder__in=folder.subtree_ids()).select_related('folder__owner')
+        page = self.paginate_queryset(queryset)
+        serializer = PageSerializer(page, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=True)
+    def tasks(self, request, pk=None):
+        folder = self.get_object()
+        queryset = visible_tasks(request.user).using(folder._state.db) \
+            .filter(page__folder__in=folder.subtree_ids()).select_related('page', 'user')
+        page = self.paginate_queryset(queryset)
+        serializer = TaskSerializer(page, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['post'])
+    def copy(self, request, pk=None):
+        # parent не передан - копия рядом с исходной папкой, null - копия становится корневой
+        folder = self.get_object()
+        return self.copy_response('folder', folder, self.get_copy_target('parent', folder.parent))
+
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
-    def get_queryset(self):
+    def check_restore_permission(self, instance):
+        if instance.owner_id != self.request.user.pk:
+            raise PermissionDenied("У вас нет прав на восстановление этой папки.")
+
+    def include_pages(self, queryset, limit):
+        return queryset.prefetch_related(Prefetch(
+            'page_set',
+            queryset=visible_pages(self.request.user).order_by('id')[:limit + 1],
+            to_attr='included_pages',
+        ))
+
+    def include_children(self, queryset, limit):
+        return queryset.prefetch_related(Prefetch(
+            'children',
+            queryset=visible_folders(self.request.user).select_related('owner').order_by('id')[:limit + 1],
+            to_attr='included_children',
+        ))
+
+    def include_permissions(self, queryset, limit):
+        # Как в FolderPermissionViewSet: права папки видит только ее владелец
         user = self.request.user
-        if user.is_authenticated:
-            # Фильтруем только если пользователь авторизован
-            return Folder.objects.filter(
-                Q(owner=user) | Q(permissions__in=[user]) | Q(is_public=True)
-            ).filter(is_deleted=False).distinct()  # Добавлен фильтр is_deleted=False
-        else:
-            # Для неавторизованных пользователей возвращаем только публичные папки
-            return Folder.objects.filter(is_public=True, is_deleted=False).distinct()
+        if not user.is_authenticated:
+            raise NotAuthenticated("Права доступа видны только авторизованным пользователям")
+        return queryset.prefetch_related(Prefetch(
+            'folderpermission_set',
+            queryset=FolderPermission.objects.filter(folder__owner=user)
+            .select_related('user').order_by('id')[:limit + 1],
+            to_attr='included_permissions',
+        ))
 
+    def get_queryset(self):
+        return self.apply_include(self.get_visible_queryset().select_related('owner'))
+
+    def get_visible_queryset(self):
+        return visible_folders(self.request.user)
 
-class PageViewSet(SoftDeletableViewSetMixin, viewsets.ModelViewSet):
+
+class PageViewSet(ShardedViewSetMixin, SoftDeletableViewSetMixin, CopyViewSetMixin, IncludeViewSetMixin,
+                  viewsets.ModelViewSet):
     queryset = Page.objects.all()
     serializer_class = PageSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    shard_parent_field = 'folder'
+    shard_archive_model = PageArchive
+    include_options = ('tasks', 'folder', 'permissions')
 
     def perform_create(self, serializer):
         folder = serializer.validated_data['folder']
         user = self.request.user
 
         # Проверка прав доступа
-        if not (folder.owner == user or user in folder.permissions.all()):
+        if not folder.user_has_access(user):
             raise PermissionDenied("У вас нет прав на создание страницы в этой папке.")
 
         serializer.save(created_by=user, updated_by=user)
 
-    def get_queryset(self):
+    def perform_update(self, serializer):
+        serializer.save(updated_by=self.request.user)
+
+    @action(detail=True, methods=['post'])
+    def copy(self, request, pk=None):
+        page = self.get_object()
+        folder = self.get_copy_target('folder', page.folder)
+        if folder is None:
+            raise serializers.ValidationError({"folder": "Требуется ID папки"})
+        return self.copy_response('page', page, folder)
+
+    def check_restore_permission(self, instance):
+        if not (instance.folder and instance.folder.user_has_access(self.request.user)):
+            raise PermissionDenied("У вас нет прав на восстановление этой страницы.")
+
+    def include_tasks(self, queryset, limit):
+        return queryset.prefetch_related(Prefetch(
+            'task_set',
+            queryset=Task.objects.filter(is_deleted=False).select_related('user').order_by('rank', 'id')[:limit + 1],
+            to_attr='included_tasks',
+        ))
+
+    def include_folder(self, queryset, limit):
+        # Папка и так отдается в folder_data - подтягиваем ее тем же запросом
+        return queryset.select_related('folder__owner')
+
+    def include_permissions(self, queryset, limit):
+        # Те же строки, что отдает PagePermissionViewSet
         user = self.request.user
+        if not user.is_authenticated:
+            raise NotAuthenticated("Права доступа видны только авторизованным пользователям")
+        return queryset.prefetch_related(Prefetch(
+            'pagepermission_set',
+            queryset=visible_page_permissions(user).select_related('user').order_by('id')[:limit + 1],
+            to_attr='included_permissions',
+        ))
 
-        if user.has_perm('todo.view_page'):
-            return Page.objects.all().filter(is_deleted=False)
+    def get_queryset(self):
+        return self.apply_include(self.get_visible_queryset())
 
-        if user.is_authenticated:
-            return Page.objects.filter(
-                Q(folder__owner=user) |
-                Q(folder__permissions__in=[user]) |
-                Q(is_public=True)
-            ).filter(is_deleted=False).distinct()
-        else:
-            return Page.objects.filter(is_public=True, is_deleted=False).distinct()
+    def get_visible_queryset(self):
+        return visible_pages(self.request.user)
 
 
-class TaskViewSet(SoftDeletableViewSetMixin, viewsets.ModelViewSet):
+class TaskViewSet(ShardedViewSetMixin, SoftDeletableViewSetMixin, viewsets.ModelViewSet):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    shard_parent_field = 'page'
+    shard_archive_model = TaskArchive
+
+    def get_request_shard(self):
+        page_id = self.request.query_params.get('page')
+        if self.action == 'list' and page_id and page_id.isdigit():
+            # Задачи одной страницы лежат на ее шарде - обходить остальные не нужно
+            return sharding.locate_shard(Page, page_id)
+        return super().get_request_shard()
 
     def perform_create(self, serializer):
         page_id = self.request.data.get('page')
@@ -111,31 +401,128 @@ class TaskViewSet(SoftDeletableViewSetMixin, viewsets.ModelViewSet):
         user = self.request.user
 
         # Проверка прав доступа к странице и папке
-        if not (page.folder.owner == user or user in page.folder.permissions.all() or page.is_public):
+        if not (page.is_public or page.folder.user_has_access(user)):
             raise PermissionDenied("У вас нет прав на создание задачи на этой странице.")
 
-        serializer.save(created_by=user, updated_by=user, page=page)
-
-    def get_queryset(self):
-        user = self.request.user
-
-        if user.has_perm('todo.view_task'):
-            return Task.objects.all().filter(is_deleted=False)
+        serializer.save(created_by=user, updated_by=user, page=page, rank=Task.rank_at_end(page.pk))
+
+    def perform_update(self, serializer):
+        serializer.save(updated_by=self.request.user)
+
+    def check_restore_permission(self, instance):
+        page = instance.page
+        if not (page and page.folder and page.folder.user_has_access(self.request.user)):
+            raise PermissionDenied("У вас нет прав на восстановление этой задачи.")
+
+    @action(detail=True, methods=['post'])
+    def move(self, request, pk=None):
+        task = self.get_object()
+        neighbours = self.get_move_neighbours(task)
+        if 'after' in neighbours and 'before' in neighbours:
+            after, before = neighbours['after'], neighbours['before']
+            # Порядок списка - (rank, id): так же сравниваются и задачи с одинаковыми ключами
+            if (after.rank, after.pk) >= (before.rank, before.pk):
+                raise serializers.ValidationError("Задача after должна стоять выше задачи before")
+
+        rank = self.get_move_rank(task, neighbours)
+        if rank is None or len(rank) > RANK_MAX_LENGTH:
+            # Ключи исчерпались или у соседей совпадают (параллельные добавления, пустой ключ у задач,
+            # созданных в обход API): перенумеровываем страницу сразу и считаем ключ заново
+            Task.rebalance_ranks(task.page_id)
+            for neighbour in neighbours.values():
+                neighbour.refresh_from_db(fields=['rank'])
+            rank = self.get_move_rank(task, neighbours)
+            if rank is None:
+                raise serializers.ValidationError("Задача after должна стоять выше задачи before")
+
+        task.rank = rank
+        task.save(update_fields=['rank'])
+        return Response(self.get_serializer(task).data)
+
+    def get_move_neighbours(self, task):
+        # Клиент передает соседей: after - задача перед новым местом, before - после него
+        siblings = Task.objects.filter(page_id=task.page_id).exclude(pk=task.pk)
+        neighbours = {}
+        for key in ('after', 'before'):
+            neighbour_id = self.request.data.get(key)
+            if neighbour_id is None:
+                continue
+            try:
+                neighbours[key] = siblings.get(pk=neighbour_id)
+            except (Task.DoesNotExist, ValueError):
+                raise serializers.ValidationError({key: "Задача не найдена на этой странице"})
+        if not neighbours:
+            raise serializers.ValidationError("Укажите after или before")
+        return neighbours
+
+    def get_move_rank(self, task, neighbours):
+        # Ключ между соседями или None, если между их ключами места нет
+        siblings = Task.objects.filter(page_id=task.page_id).exclude(pk=task.pk)
+        for neighbour in neighbours.values():
+            if siblings.filter(rank=neighbour.rank).exclude(pk=neighbour.pk).exists():
+                return None
+        if 'after' in neighbours:
+            after_rank = neighbours['after'].rank
+        else:
+            after_rank = siblings.filter(rank__lt=neighbours['before'].rank).order_by('-rank') \
+                .values_list('rank', flat=True).first()
 
-        if user.is_authenticated:
-            return Task.objects.filter(
-                Q(page__folder__owner=user) |
-                Q(page__folder__permissions__in=[user]) |
-                Q(page__is_public=True)
-            ).filter(is_deleted=False).distinct()
+        if 'before' in neighbours:
+            before_rank = neighbours['before'].rank
         else:
-            return Task.objects.filter(page__is_public=True, is_deleted=False, page__is_deleted=False).distinct()
+            before_rank = siblings.filter(rank__gt=after_rank).order_by('rank') \
+                .values_list('rank', flat=True).first()
 
+        try:
+            return rank_between(after_rank, before_rank)
+        except ValueError:
+            return None
 
-class FolderPermissionViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        queryset = self.get_visible_queryset()
+        page_id = self.request.query_params.get('page')
+        if page_id:
+            if not page_id.isdigit():
+                raise serializers.ValidationError({"page": "Некорректный ID страницы"})
+            # Упорядоченный список страницы читается по индексу (page_id, rank)
+            queryset = queryset.filter(page_id=page_id).order_by('rank', 'id')
+        return self.filter_due(queryset)
+
+    def filter_due(self, queryset):
+        # ?overdue=true и ?due_after=/?due_before= (ISO 8601) читаются по частичным индексам на due_at
+        params = self.request.query_params
+        window = {}
+        for name, lookup in (('due_after', 'due_at__gte'), ('due_before', 'due_at__lt')):
+            value = params.get(name)
+            if value:
+                try:
+                    moment = parse_datetime(value)
+                except ValueError:
+                    moment = None
+                if moment is None:
+                    raise serializers.ValidationError({name: "Некорректная дата, ожидается ISO 8601"})
+                if timezone.is_naive(moment):
+                    moment = timezone.make_aware(moment)
+                window[lookup] = moment
+        overdue = params.get('overdue', '').lower() in ('1', 'true', 'yes')
+        if not window and not overdue:
+            return queryset
+        if overdue:
+            queryset = queryset.filter(status=Task.OPEN_STATUS, due_at__lt=timezone.now())
+        queryset = queryset.filter(due_at__isnull=False, **window)
+        if not params.get('page'):
+            queryset = queryset.order_by('due_at', 'id')
+        return queryset
+
+    def get_visible_queryset(self):
+        return visible_tasks(self.request.user)
+
+
+class FolderPermissionViewSet(ShardedViewSetMixin, viewsets.ModelViewSet):
     queryset = FolderPermission.objects.all()
     serializer_class = FolderPermissionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    shard_parent_field = 'folder'
 
     def get_queryset(self):
         user = self.request.user
@@ -155,15 +542,23 @@ class FolderPermissionViewSet(viewsets.ModelViewSet):
         instance.delete()
 
 
-class PagePermissionViewSet(viewsets.ModelViewSet):
+def visible_page_permissions(user):
+    # Одно условие с EXISTS вместо объединения трех выборок: без JOIN по правам и дублей строк
+    return PagePermission.objects.filter(
+        Q(page__folder__owner=user) |
+        Q(page__is_public=True) |
+        Exists(PagePermission.objects.filter(page=OuterRef('page'), user=user))
+    )
+
+
+class PagePermissionViewSet(ShardedViewSetMixin, viewsets.ModelViewSet):
     queryset = PagePermission.objects.all()
     serializer_class = PagePermissionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    shard_parent_field = 'page'
 
     def get_queryset(self):
-        user = self.request.user
-        return PagePermission.objects.filter(page__folder__owner=user) | PagePermission.objects.filter(
-            page__permissions__in=[user]) | PagePermission.objects.filter(page__is_public=True)
+        return visible_page_permissions(self.request.user)
 
     def perform_create(self, serializer):
         page = serializer.validated_data.get('page')
@@ -176,19 +571,18 @@ class PagePermissionViewSet(viewsets.ModelViewSet):
         serializer.save()
 
 
-class TaskPermissionViewSet(viewsets.ModelViewSet):
+class TaskPermissionViewSet(ShardedViewSetMixin, viewsets.ModelViewSet):
     queryset = TaskPermission.objects.all()
     serializer_class = TaskPermissionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    shard_parent_field = 'task'
 
     def get_queryset(self):
         user = self.request.user
         return TaskPermission.objects.filter(
-            task__page__folder__owner=user
-        ) | TaskPermission.objects.filter(
-            task__page__permissions__in=[user]
-        ) | TaskPermission.objects.filter(
-            task__page__is_public=True
+            Q(task__page__folder__owner=user) |
+            Q(task__page__is_public=True) |
+            Exists(PagePermission.objects.filter(page=OuterRef('task__page'), user=user))
         )
 
     def perform_create(self, serializer):
@@ -198,3 +592,36 @@ class TaskPermissionViewSet(viewsets.ModelViewSet):
                 pk=self.request.user.pk).exists():
             raise serializers.ValidationError("Вы не можете назначать права для этой задачи.")
         serializer.save()
+
+
+class PermissionBatchViewSet(ShardedViewSetMixin, viewsets.ViewSet):
+    # POST {"grant": [{"folder"|"page"|"task": id, "user": id, "can_view": ...}], "revoke": [{...}]}
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_request_shard(self):
+        shards = sharding.get_shards()
+        if len(shards) == 1:
+            return shards[0]
+        # Пакет обрабатывается одной транзакцией, поэтому все объекты должны лежать на шарде первого из них
+        for key in ('grant', 'revoke'):
+            items = self.request.data.get(key)
+            for item in items if isinstance(items, list) else []:
+                for kind, model in (('folder', Folder), ('page', Page), ('task', Task)):
+                    target = item.get(kind) if isinstance(item, dict) else None
+                    if target is not None and str(target).isdigit():
+                        return sharding.locate_shard(model, target)
+        return None
+
+    def create(self, request):
+        serializer = PermissionBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(grants.apply_batch(request.user, **serializer.validated_data))
+
+
+class CopyJobViewSet(ShardedViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = CopyJob.objects.all()
+    serializer_class = CopyJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user).order_by('-id')
@@ -89,6 +89,14 @@ DATABASES = {
     }
 }
 
+# Базы с папками, страницами и задачами (см. todo.sharding). Первая служит каталогом шардов
+# и хранит пользователей. Для локальной проверки можно добавить в DATABASES несколько
+# SQLite-баз и перечислить их здесь, затем выполнить migrate --database для каждой.
+# id объектов кодируют индекс шарда в этом списке: новые шарды добавляются только в конец.
+TODO_SHARDS = ['default']
+
+DATABASE_ROUTERS = ['todo.sharding.ShardRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -192,3 +200,16 @@ SIMPLE_JWT = {
     "SLIDING_TOKEN_OBTAIN_SERIALIZER": "rest_framework_simplejwt.serializers.TokenObtainSlidingSerializer",
     "SLIDING_TOKEN_REFRESH_SERIALIZER": "rest_framework_simplejwt.serializers.TokenRefreshSlidingSerializer",
 }
+
+# Сроки хранения мягко удаленных записей, см. команду archive_deleted
+TODO_RETENTION = {
+    'ARCHIVE_AFTER_DAYS': 30,
+    'PURGE_AFTER_DAYS': 365,
+    'BATCH_SIZE': 1000,
+}
+
+# Копирование папок и страниц (todo.copying): больше SYNC_LIMIT страниц и задач - в фоне через run_copy_jobs
+TODO_COPY = {
+    'SYNC_LIMIT': 5000,
+    'BATCH_SIZE': 1000,
+}
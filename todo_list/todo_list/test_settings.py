@@ -0,0 +1,17 @@
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+
+from .settings import *
+
+# Тесты без PostgreSQL: три SQLite-базы в памяти, чтобы проверять шардирование.
+# Запуск: python manage.py test todo --settings=todo_list.test_settings
+DATABASES = {
+    alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': f'{alias}.sqlite3'}
+    for alias in ('default', 's1', 's2')
+}
+TODO_SHARDS = ['default', 's1', 's2']
+
+# Task.status - CharField без max_length, такое поле допускает только PostgreSQL
+SILENCED_SYSTEM_CHECKS = ['fields.E120']
+SQLiteDatabaseWrapper.data_types = {**SQLiteDatabaseWrapper.data_types, 'CharField': 'varchar'}
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
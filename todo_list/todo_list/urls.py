@@ -24,9 +24,11 @@ router = routers.DefaultRouter()
 router.register(r'folderperm', FolderPermissionViewSet)
 router.register(r'pageperm', PagePermissionViewSet)
 router.register(r'taskperm', TaskPermissionViewSet)
+router.register(r'permbatch', views.PermissionBatchViewSet, basename='permbatch')
 router.register(r'folders', views.FolderViewSet)
 router.register(r'pages', views.PageViewSet)
 router.register(r'tasks', views.TaskViewSet)
+router.register(r'copyjobs', views.CopyJobViewSet)
 
 urlpatterns = [
     path('admin/', admin.site.urls),